@@ -0,0 +1,250 @@
+# Benchmarks of microcoapy, for CPython and the MicroPython unix port.
+#
+# usage: python3 benchmarks/benchmark.py [-n iterations] [-o results.json] [--quick]
+#
+# The results are printed, or written to the given file, as JSON so that runs
+# can be compared.
+
+import sys
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+try:
+    import gc
+except ImportError:
+    gc = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# run from any directory: the package is next to the benchmarks folder
+_BENCHMARK_DIR = __file__.rsplit("/", 1)[0] if "/" in __file__ else "."
+sys.path.insert(0, _BENCHMARK_DIR + "/..")
+
+import microcoapy
+from microcoapy.coap_packet import CoapPacket
+from microcoapy.coap_writer import encodeInto
+from microcoapy import coap_macros as macros
+
+try:
+    from time import perf_counter_ns
+
+    def nowUs():
+        return perf_counter_ns() // 1000
+
+    def diffUs(end, start):
+        return end - start
+
+except ImportError:
+    import utime
+
+    def nowUs():
+        return utime.ticks_us()
+
+    def diffUs(end, start):
+        return utime.ticks_diff(end, start)
+
+
+_PORT = 56830
+
+# (name, number of Uri-Path options, payload size)
+_CASES = (
+    ("empty", 1, 0),
+    ("small", 2, 16),
+    ("options", 8, 16),
+    ("payload256", 2, 256),
+    ("payload1k", 2, 900),
+)
+
+
+def makePacket(pathOptions, payloadSize):
+    packet = CoapPacket()
+    packet.type = macros.COAP_TYPE.COAP_CON
+    packet.method = macros.COAP_METHOD.COAP_POST
+    packet.messageid = 0x1234
+    packet.token = bytearray(b"\x01\x02\x03\x04")
+    packet.setUriPath("/".join(["segment%d" % i for i in range(pathOptions)]))
+    packet.content_format = macros.COAP_CONTENT_FORMAT.COAP_APPLICATION_JSON
+    packet.prepareOptions()
+    packet.content_format = macros.COAP_CONTENT_FORMAT.COAP_NONE
+    packet.payload = bytes(payloadSize)
+    return packet
+
+
+# Decodes datagrams the way they are received, with Coap.parseDatagram.
+def makeDecoder(zeroCopy):
+    coap = microcoapy.Coap()
+    coap.debug = False
+    coap.zeroCopyDecode = zeroCopy
+    return coap
+
+
+# Runs function(arg) 'iterations' times and returns the elapsed microseconds.
+def timeIt(function, arg, iterations):
+    start = nowUs()
+    for _ in range(iterations):
+        function(arg)
+    return diffUs(nowUs(), start)
+
+
+def throughput(elapsedUs, iterations, size):
+    seconds = max(elapsedUs, 1) / 1000000
+    return {"opsPerSecond": round(iterations / seconds), "megabytesPerSecond": round(iterations * size / seconds / 1000000, 2)}
+
+
+# Memory allocated by one call of function(arg). On CPython, tracemalloc gives
+# the peak of the temporary allocations and the memory kept by the result; on
+# MicroPython, the heap allocation of the call is measured with the collector
+# disabled.
+def allocations(function, arg, iterations):
+    if tracemalloc is not None:
+        tracemalloc.start()
+        peak = 0
+        for _ in range(iterations):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            function(arg)
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+
+        results = []
+        before = tracemalloc.get_traced_memory()[0]
+        for _ in range(iterations):
+            results.append(function(arg))
+        retained = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        return {"peakBytes": peak, "retainedBytes": retained // iterations}
+
+    if (gc is not None) and hasattr(gc, "mem_alloc"):
+        gc.collect()
+        gc.disable()
+        before = gc.mem_alloc()
+        for _ in range(iterations):
+            function(arg)
+        allocated = gc.mem_alloc() - before
+        gc.enable()
+        return {"allocatedBytes": allocated // iterations}
+
+    return None
+
+
+def benchmarkCodec(iterations):
+    results = {}
+    buffer = bytearray(macros._BUF_MAX_SIZE)
+    # a receive buffer, as filled by recvfrom_into
+    received = bytearray(macros._BUF_MAX_SIZE)
+    copyDecoder = makeDecoder(False)
+    zeroCopyDecoder = makeDecoder(True)
+    for name, pathOptions, payloadSize in _CASES:
+        packet = makePacket(pathOptions, payloadSize)
+        length = encodeInto(buffer, packet)
+        received[:length] = buffer[:length]
+
+        def decode(buffer):
+            return copyDecoder.parseDatagram(buffer, length)
+
+        def decodeZeroCopy(buffer):
+            return zeroCopyDecoder.parseDatagram(buffer, length)
+
+        # zero-copy decoding of a packet that is kept, e.g. by an asyncio handler
+        def decodeZeroCopyKept(buffer):
+            packet = zeroCopyDecoder.parseDatagram(buffer, length)
+            packet.materialize()
+            return packet
+
+        results[name] = {
+            "size": length,
+            "encode": throughput(timeIt(lambda p: encodeInto(buffer, p), packet, iterations), iterations, length),
+            "decode": throughput(timeIt(decode, received, iterations), iterations, length),
+            "decodeZeroCopy": throughput(timeIt(decodeZeroCopy, received, iterations), iterations, length),
+            "decodeZeroCopyKept": throughput(timeIt(decodeZeroCopyKept, received, iterations), iterations, length),
+            "encodeAllocations": allocations(lambda p: encodeInto(buffer, p), packet, min(iterations, 1000)),
+            "decodeAllocations": allocations(decode, received, min(iterations, 1000)),
+            "decodeZeroCopyAllocations": allocations(decodeZeroCopy, received, min(iterations, 1000)),
+            "decodeZeroCopyKeptAllocations": allocations(decodeZeroCopyKept, received, min(iterations, 1000)),
+        }
+    return results
+
+
+def percentile(sortedValues, fraction):
+    return sortedValues[min(len(sortedValues) - 1, int(len(sortedValues) * fraction))]
+
+
+# Round trips of a confirmable GET between a client and a server bound to the
+# loopback interface, both served from this thread.
+def benchmarkLoopback(iterations):
+    server = microcoapy.Coap()
+    server.debug = False
+    server.addIncomingRequestCallback(
+        "bench",
+        lambda packet, ip, port: server.sendResponse(
+            ip, port, packet.messageid, b"ok", macros.COAP_RESPONSE_CODE.COAP_CONTENT, macros.COAP_CONTENT_FORMAT.COAP_NONE, packet.token
+        ),
+    )
+    client = microcoapy.Coap()
+    client.debug = False
+    server.start(_PORT)
+    client.start(_PORT + 1)
+
+    latencies = []
+    failures = 0
+    try:
+        start = nowUs()
+        for _ in range(iterations):
+            requestStart = nowUs()
+            client.get("127.0.0.1", _PORT, "bench")
+            server.loop(True)
+            if client.loop(True):
+                latencies.append(diffUs(nowUs(), requestStart))
+            else:
+                failures += 1
+        elapsedUs = diffUs(nowUs(), start)
+    finally:
+        server.stop()
+        client.stop()
+
+    latencies.sort()
+    result = {"roundTrips": len(latencies), "failures": failures}
+    if latencies:
+        result["roundTripsPerSecond"] = round(len(latencies) / (max(elapsedUs, 1) / 1000000))
+        result["p50Us"] = percentile(latencies, 0.5)
+        result["p99Us"] = percentile(latencies, 0.99)
+    return result
+
+
+def main(argv):
+    iterations = 10000
+    output = None
+    i = 1
+    while i < len(argv):
+        if argv[i] == "-n":
+            iterations = int(argv[i + 1])
+            i += 1
+        elif argv[i] == "-o":
+            output = argv[i + 1]
+            i += 1
+        elif argv[i] == "--quick":
+            iterations = 1000
+        i += 1
+
+    results = {
+        "implementation": sys.implementation.name,
+        "version": ".".join([str(v) for v in sys.implementation.version[:3]]),
+        "iterations": iterations,
+        "codec": benchmarkCodec(iterations),
+        "loopback": benchmarkLoopback(max(iterations // 10, 100)),
+    }
+
+    if output is None:
+        print(json.dumps(results))
+    else:
+        with open(output, "w") as f:
+            f.write(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
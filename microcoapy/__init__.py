@@ -1,3 +1,6 @@
 from .microcoapy import Coap
 from .coap_macros import COAP_CONTENT_FORMAT
 from .coap_macros import COAP_RESPONSE_CODE
+from .coap_macros import COAP_METHOD
+from .coap_macros import COAP_TYPE
+from .coap_macros import COAP_OPTION_NUMBER
@@ -0,0 +1,176 @@
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+try:
+    import socket
+except ImportError:
+    import usocket as socket
+
+from . import coap_macros as macros
+from .coap_packet import CoapPacket
+from .microcoapy import Coap
+
+
+# Receives the datagrams of an asyncio datagram endpoint (CPython).
+class _DatagramProtocol:
+    def __init__(self, coap):
+        self.coap = coap
+
+    def connection_made(self, transport):
+        pass
+
+    def datagram_received(self, data, addr):
+        self.coap.processDatagram(data, addr)
+
+    def error_received(self, exc):
+        self.coap.log("Datagram endpoint error: " + str(exc))
+
+    def connection_lost(self, exc):
+        pass
+
+
+# Exposes an asyncio datagram transport through the socket functions used by Coap.
+class _TransportSocket:
+    def __init__(self, transport):
+        self.transport = transport
+
+    def sendto(self, bytes, address):
+        self.transport.sendto(bytes, address)
+        return len(bytes)
+
+    def setblocking(self, flag):
+        pass
+
+    def close(self):
+        self.transport.close()
+
+
+# Suspends the calling task until the socket is readable (MicroPython).
+def _waitReadable(sock):
+    yield asyncio.core._io_queue.queue_read(sock)
+
+
+# Completion of a request, set by the transaction callback.
+class _PendingRequest:
+    def __init__(self):
+        self.event = asyncio.Event()
+        self.packet = None
+
+    def complete(self, packet, remoteAddress):
+        if packet is not None:
+            # it is read after the receive buffer has been reused
+            packet.materialize()
+        self.packet = packet
+        self.event.set()
+
+
+class AsyncCoap(Coap):
+    def __init__(self):
+        super().__init__()
+        self.receiveTask = None
+        self.timerTask = None
+        # set when a timer is scheduled before the one the timer task waits for
+        self.timerEvent = asyncio.Event()
+        self.timers.wakeup = self.timerEvent.set
+        # custom sockets cannot be registered to the event loop, so they are polled
+        self.customSocketPollMs = 10
+
+    # Creates the UDP endpoint. On CPython an asyncio datagram endpoint is used,
+    # on MicroPython a non blocking socket is read by a background task.
+    async def start(self, port=macros._COAP_DEFAULT_PORT):
+        loop = asyncio.get_event_loop()
+        if hasattr(loop, "create_datagram_endpoint"):
+            transport, protocol = await loop.create_datagram_endpoint(lambda: _DatagramProtocol(self), local_addr=("0.0.0.0", port))
+            self.sock = _TransportSocket(transport)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.bind(("", port))
+            self.sock.setblocking(False)
+            self.receiveTask = asyncio.create_task(self.receiveLoop(False))
+        self.timerTask = asyncio.create_task(self.timerLoop())
+
+    def stop(self):
+        for task in (self.receiveTask, self.timerTask):
+            if task is not None:
+                task.cancel()
+        self.receiveTask = None
+        self.timerTask = None
+        super().stop()
+
+    def setCustomSocket(self, custom_socket):
+        super().setCustomSocket(custom_socket)
+        self.sock.setblocking(False)
+        self.receiveTask = asyncio.create_task(self.receiveLoop(True))
+        self.timerTask = asyncio.create_task(self.timerLoop())
+
+    async def receiveLoop(self, polling):
+        while self.sock is not None:
+            if polling:
+                await asyncio.sleep(self.customSocketPollMs / 1000)
+            else:
+                await _waitReadable(self.sock)
+            (buffer, length, remoteAddress) = self.receiveDatagram()
+            if buffer is not None:
+                self.processDatagram(buffer, remoteAddress, length)
+
+    # Runs the retransmission and expiration timers. It sleeps until the first
+    # timer is due, or until an earlier timer is scheduled.
+    async def timerLoop(self):
+        while self.sock is not None:
+            self.timers.run()
+            delayMs = self.timers.nextDelayMs()
+            self.timerEvent.clear()
+            if delayMs < 0:
+                await self.timerEvent.wait()
+                continue
+            try:
+                await asyncio.wait_for(self.timerEvent.wait(), delayMs / 1000)
+            except asyncio.TimeoutError:
+                pass
+
+    # Sends a request and waits for its response. Returns the response packet,
+    # or None if the request could not be sent or no response arrived in time.
+    # Without timeoutMs, the request fails when its retransmissions are exhausted
+    # or its exchange lifetime ends.
+    async def request(
+        self, ip, port, url, method, payload=None, query_option=None, content_format=macros.COAP_CONTENT_FORMAT.COAP_NONE, type=macros.COAP_TYPE.COAP_CON, timeoutMs=None
+    ):
+        packet = CoapPacket()
+        packet.type = type
+        packet.method = method
+        packet.payload = payload
+        packet.content_format = content_format
+        packet.query = query_option
+
+        pending = _PendingRequest()
+        if self.sendEx(ip, port, url, packet, pending.complete) == 0:
+            return None
+        try:
+            if timeoutMs is None:
+                await pending.event.wait()
+            else:
+                await asyncio.wait_for(pending.event.wait(), timeoutMs / 1000)
+        except asyncio.TimeoutError:
+            self.log("No response received for messageid: " + str(packet.messageid))
+            self.cancelTransaction(self.resolveAddress(ip, port), packet.token)
+        return pending.packet
+
+    async def get(self, ip, port, url, timeoutMs=None):
+        return await self.request(ip, port, url, macros.COAP_METHOD.COAP_GET, timeoutMs=timeoutMs)
+
+    async def put(self, ip, port, url, payload=bytearray(), query_option=None, content_format=macros.COAP_CONTENT_FORMAT.COAP_NONE, timeoutMs=None):
+        return await self.request(ip, port, url, macros.COAP_METHOD.COAP_PUT, payload, query_option, content_format, timeoutMs=timeoutMs)
+
+    async def post(self, ip, port, url, payload=bytearray(), query_option=None, content_format=macros.COAP_CONTENT_FORMAT.COAP_NONE, timeoutMs=None):
+        return await self.request(ip, port, url, macros.COAP_METHOD.COAP_POST, payload, query_option, content_format, timeoutMs=timeoutMs)
+
+    # Request callbacks may be coroutine functions, in which case they run as
+    # separate tasks and the receiving of packets continues immediately.
+    def runRequestCallback(self, callback, requestPacket, sourceIp, sourcePort):
+        result = callback(requestPacket, sourceIp, sourcePort)
+        if (result is not None) and hasattr(result, "send"):
+            # the task runs after the receive buffer may have been reused
+            requestPacket.materialize()
+            asyncio.create_task(result)
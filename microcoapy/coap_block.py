@@ -0,0 +1,203 @@
+from . import coap_macros as macros
+from .coap_packet import CoapPacket
+
+# Block-wise transfers (rfc7959)
+
+
+# SZX of the largest block size (16 to 1024 bytes) that is not larger than size.
+def blockSizeToSzx(size):
+    szx = 0
+    while (szx < 6) and ((32 << szx) <= size):
+        szx += 1
+    return szx
+
+# The uint value of a Block1/Block2 option.
+def encodeBlock(num, more, szx):
+    return (num << 4) | (0x08 if more else 0) | szx
+
+# Returns (num, more, szx) of the uint value of a Block1/Block2 option.
+def decodeBlock(value):
+    return (value >> 4, (value & 0x08) != 0, value & 0x07)
+
+# Identifies the transfer of a request: its endpoint and Uri-Path (rfc7959 #2.4)
+def transferKey(packet, ip, port):
+    path = b"/".join([bytes(segment) for segment in packet.getOptions(macros.COAP_OPTION_NUMBER.COAP_URI_PATH)])
+    return (ip, port, path)
+
+def writeToSink(sink, data):
+    if hasattr(sink, "write"):
+        sink.write(data)
+    else:
+        sink(data)
+
+
+# Reads a representation block by block from a producer: a bytes-like object,
+# a file-like object or an iterable (e.g. a generator) of bytes chunks. Only
+# the current block, plus one byte to detect the end of the data, is kept.
+class BlockSource:
+    def __init__(self, source):
+        self.source = source
+        self.offset = 0
+        self.pending = b""
+        self.eof = False
+        self.chunks = None
+        if isinstance(source, str):
+            self.source = source.encode()
+        elif not isinstance(source, (bytes, bytearray, memoryview)) and not hasattr(source, "read"):
+            self.chunks = iter(source)
+
+    def isBytes(self):
+        return (self.chunks is None) and not hasattr(self.source, "read")
+
+    # True if blocks can only be read in order
+    def isSequential(self):
+        return (self.chunks is not None) or (hasattr(self.source, "read") and not hasattr(self.source, "seek"))
+
+    def fill(self, size):
+        while (len(self.pending) < size) and not self.eof:
+            if self.chunks is not None:
+                chunk = next(self.chunks, None)
+            else:
+                chunk = self.source.read(size - len(self.pending))
+            if not chunk:
+                self.eof = True
+            else:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode()
+                self.pending = self.pending + chunk if self.pending else bytes(chunk)
+
+    # Returns the next block of the given size and whether more data follows.
+    def take(self, size):
+        if self.isBytes():
+            data = self.source[self.offset:self.offset + size]
+            self.offset += len(data)
+            return (data, self.offset < len(self.source))
+
+        self.fill(size + 1)
+        data = self.pending[:size]
+        self.pending = self.pending[size:]
+        self.offset += len(data)
+        return (data, len(self.pending) > 0)
+
+    # Returns the block at the given offset. Bytes-like and seekable sources
+    # support any offset, other sources only the offset right after the
+    # previous block. Returns None if the offset cannot be served.
+    def takeAt(self, offset, size):
+        if self.isBytes():
+            self.offset = offset
+        elif hasattr(self.source, "seek"):
+            self.source.seek(offset)
+            self.offset = offset
+            self.pending = b""
+            self.eof = False
+        elif offset != self.offset:
+            return None
+        return self.take(size)
+
+    # Puts back the end of a block that has not been sent, when the block size
+    # has been reduced by the peer.
+    def pushBack(self, data):
+        self.offset -= len(data)
+        if not self.isBytes():
+            self.pending = bytes(data) + self.pending
+
+
+# Client side of a block-wise transfer: downloads a representation with Block2
+# into a sink, or uploads one from a producer with Block1. Each block is sent
+# as a separate request that is matched through the transaction table.
+class CoapBlockTransfer:
+    def __init__(self, coap, ip, port, url, method, source, sink, callback, blockSize, content_format):
+        self.coap = coap
+        self.ip = ip
+        self.port = port
+        self.url = url
+        self.method = method
+        self.source = BlockSource(source) if source is not None else None
+        self.sink = sink
+        self.callback = callback
+        self.content_format = content_format
+        self.szx = blockSizeToSzx(blockSize)
+        self.num = 0
+        self.block = None
+        self.more = False
+        self.token = coap.newToken()
+
+    def start(self):
+        if self.source is not None:
+            (self.block, self.more) = self.source.take(16 << self.szx)
+        return self.send()
+
+    def sendNext(self, remoteAddress):
+        if self.send() == 0:
+            self.finish(None, remoteAddress)
+
+    def send(self):
+        packet = CoapPacket()
+        packet.type = macros.COAP_TYPE.COAP_CON
+        packet.method = self.method
+        packet.token = self.token
+        packet.content_format = self.content_format
+        if self.source is not None:
+            packet.addUintOption(macros.COAP_OPTION_NUMBER.COAP_BLOCK1, encodeBlock(self.num, self.more, self.szx))
+            packet.payload = self.block
+        else:
+            packet.addUintOption(macros.COAP_OPTION_NUMBER.COAP_BLOCK2, encodeBlock(self.num, False, self.szx))
+        return self.coap.sendEx(self.ip, self.port, self.url, packet, self.onResponse)
+
+    def finish(self, packet, remoteAddress):
+        if self.callback is not None:
+            self.callback(packet, remoteAddress)
+
+    def onResponse(self, packet, remoteAddress):
+        if packet is None:
+            self.finish(None, remoteAddress)
+            return
+
+        if self.source is not None:
+            self.onUploadResponse(packet, remoteAddress)
+        else:
+            self.onDownloadResponse(packet, remoteAddress)
+
+    def onUploadResponse(self, packet, remoteAddress):
+        # the server may ask for smaller blocks (rfc7959 #2.5)
+        szx = self.szx
+        block1 = packet.getUintOption(macros.COAP_OPTION_NUMBER.COAP_BLOCK1)
+        if block1 is not None:
+            szx = min(szx, decodeBlock(block1)[2])
+
+        if (packet.method == macros.COAP_RESPONSE_CODE.COAP_REQUEST_ENTITY_TOO_LARGE) and (szx < self.szx):
+            # the block has been rejected, send it again in smaller blocks
+            size = 16 << szx
+            self.source.pushBack(self.block[size:])
+            self.more = self.more or (len(self.block) > size)
+            self.block = self.block[:size]
+            self.num = self.num << (self.szx - szx)
+            self.szx = szx
+            self.sendNext(remoteAddress)
+        elif (packet.method == macros.COAP_RESPONSE_CODE.COAP_CONTINUE) and self.more:
+            # the block has been stored, continue after it
+            offset = (self.num << (self.szx + 4)) + len(self.block)
+            self.szx = szx
+            self.num = offset >> (szx + 4)
+            (self.block, self.more) = self.source.take(16 << self.szx)
+            self.sendNext(remoteAddress)
+        else:
+            self.finish(packet, remoteAddress)
+
+    def onDownloadResponse(self, packet, remoteAddress):
+        if packet.payload is not None and len(packet.payload) > 0 and (packet.method >> 5) == 2:
+            writeToSink(self.sink, packet.payload)
+
+        block2 = packet.getUintOption(macros.COAP_OPTION_NUMBER.COAP_BLOCK2)
+        if block2 is None:
+            self.finish(packet, remoteAddress)
+            return
+
+        (num, more, szx) = decodeBlock(block2)
+        if more and (packet.method >> 5) == 2:
+            # continue with the block size chosen by the server
+            self.num = num + 1
+            self.szx = szx
+            self.sendNext(remoteAddress)
+        else:
+            self.finish(packet, remoteAddress)
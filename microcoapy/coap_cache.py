@@ -0,0 +1,144 @@
+try:
+    import os
+except ImportError:
+    import uos as os
+
+from . import coap_macros as macros
+from .coap_table import CoapBoundedTable
+
+# Responses of the server to GET requests, see Coap.cacheResource.
+#
+# A response is stored encoded, without its header and token, so that it can
+# be sent again by only writing the header and the token of the new request in
+# front of it. Entries are keyed by the Uri-Path, Uri-Query and Accept options
+# of the request, expire after their Max-Age and are evicted in insertion
+# order when the cache is full.
+class CoapResponseCache:
+    def __init__(self, size):
+        # route -> Max-Age in seconds
+        self.routes = {}
+        # key -> [expiresMs, etag, code, encoded options and payload]
+        self.entries = CoapBoundedTable(size)
+        # (peer, messageid) -> (key, maxAge) of requests whose response is to be stored
+        self.pending = {}
+        # random start, so that entity tags are not reused after a restart
+        randBytes = os.urandom(4)
+        self.etagCounter = (randBytes[0] << 24) | (randBytes[1] << 16) | (randBytes[2] << 8) | randBytes[3]
+
+    def __len__(self):
+        return len(self.entries)
+
+    # The cache key of a request.
+    @staticmethod
+    def requestKey(packet):
+        path = b"/".join([bytes(segment) for segment in packet.getOptions(macros.COAP_OPTION_NUMBER.COAP_URI_PATH)])
+        query = b"&".join([bytes(segment) for segment in packet.getOptions(macros.COAP_OPTION_NUMBER.COAP_URI_QUERY)])
+        return (path, query, packet.getUintOption(macros.COAP_OPTION_NUMBER.COAP_ACCEPT))
+
+    # Returns the fresh entry of a key, or None.
+    def lookup(self, key, nowMs):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= nowMs:
+            self.remove(key)
+            return None
+        return entry
+
+    def store(self, key, nowMs, maxAge, etag, code, data):
+        self.entries.put(key, [nowMs + maxAge * 1000, etag, code, data])
+
+    def remove(self, key):
+        self.entries.remove(key)
+
+    # Removes the entries of a path, e.g. "sensors/temp", or all of them.
+    def invalidate(self, path=None):
+        if path is None:
+            for key in list(self.entries):
+                self.remove(key)
+            return
+        path = "/".join([s for s in path.split("/") if s != ""]).encode()
+        for key in list(self.entries):
+            if key[0] == path:
+                self.remove(key)
+
+    # A new entity tag, unique among the responses stored by this cache.
+    def newEtag(self):
+        self.etagCounter = (self.etagCounter + 1) & 0xFFFFFFFF
+        value = self.etagCounter
+        return bytes([(value >> 24) & 0xFF, (value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF])
+
+
+# Responses received by a client for its GET requests, see
+# Coap.enableClientCache.
+#
+# Entries are keyed by endpoint, path, query and Accept option, and are fresh
+# for the Max-Age of their response. Stale entries are kept so that they can be
+# revalidated with their ETag. The cache is bounded by the approximate memory
+# of its responses; the oldest entries are evicted first.
+class CoapClientCache:
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.usedBytes = 0
+        # key -> [expiresMs, response packet, size]
+        self.entries = {}
+        # keys in insertion order
+        self.order = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    # The cache key of a request, or None if the request cannot be cached.
+    @staticmethod
+    def requestKey(sockaddr, url, packet):
+        if (packet.findOption(macros.COAP_OPTION_NUMBER.COAP_OBSERVE) >= 0) or (packet.findOption(macros.COAP_OPTION_NUMBER.COAP_BLOCK2) >= 0):
+            return None
+        path = "/".join([s for s in url.split("/") if s != ""])
+        query = [bytes(segment) for segment in packet.getOptions(macros.COAP_OPTION_NUMBER.COAP_URI_QUERY)]
+        if packet.query:
+            query.append(packet.query.encode() if isinstance(packet.query, str) else bytes(packet.query))
+        return (sockaddr, path, b"&".join(query), packet.getUintOption(macros.COAP_OPTION_NUMBER.COAP_ACCEPT))
+
+    def lookup(self, key):
+        return self.entries.get(key)
+
+    # Updates the cache with the response of a request and returns the
+    # response to deliver: the cached one when it has been validated.
+    def onResponse(self, key, packet, nowMs):
+        maxAge = packet.getUintOption(macros.COAP_OPTION_NUMBER.COAP_MAX_AGE, macros._DEFAULT_MAX_AGE)
+        if packet.method == macros.COAP_RESPONSE_CODE.COAP_VALID:
+            entry = self.entries.get(key)
+            if entry is None:
+                return packet
+            entry[0] = nowMs + maxAge * 1000
+            return entry[1]
+
+        if (packet.method == macros.COAP_RESPONSE_CODE.COAP_CONTENT) and (maxAge > 0):
+            self.store(key, packet, nowMs + maxAge * 1000)
+        else:
+            self.remove(key)
+        return packet
+
+    def store(self, key, packet, expiresMs):
+        # the response may reference the receive buffer
+        packet.materialize()
+        size = macros._CLIENT_CACHE_ENTRY_OVERHEAD + len(packet.payload or b"") + len(packet.optionValues or b"")
+        self.remove(key)
+        if size > self.maxBytes:
+            return
+        while self.usedBytes + size > self.maxBytes:
+            self.remove(self.order[0])
+        self.entries[key] = [expiresMs, packet, size]
+        self.order.append(key)
+        self.usedBytes += size
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.order.remove(key)
+            self.usedBytes -= entry[2]
+
+    def clear(self):
+        self.entries = {}
+        self.order = []
+        self.usedBytes = 0
@@ -0,0 +1,113 @@
+from . import coap_macros as macros
+from .coap_table import CoapBoundedTable
+
+# Congestion control of confirmable messages per peer, following CoAP Simple
+# Congestion Control/Advanced (CoCoA, draft-ietf-core-cocoa), see
+# Coap.enableCongestionControl.
+
+
+# RTT estimation and probing state of a peer.
+class CoapPeerState:
+    __slots__ = ("rtoMs", "strong", "weak", "updatedMs", "silentSinceMs", "silentBytes")
+
+    def __init__(self, rtoMs, nowMs):
+        # overall retransmission timeout, combining both estimators
+        self.rtoMs = rtoMs
+        # [srtt, rttvar, rto] of the strong and weak estimators, None until measured
+        self.strong = None
+        self.weak = None
+        self.updatedMs = nowMs
+        # bytes sent since the peer last answered, and when the first was sent
+        self.silentSinceMs = 0
+        self.silentBytes = 0
+
+
+# Updates an estimator [srtt, rttvar, rto] with an RTT sample and returns it
+# (rfc6298 with the K factor of the estimator).
+def updateEstimator(estimator, rttMs, k):
+    if estimator is None:
+        estimator = [rttMs, rttMs / 2, 0]
+    else:
+        estimator[1] = 0.75 * estimator[1] + 0.25 * abs(estimator[0] - rttMs)
+        estimator[0] = 0.875 * estimator[0] + 0.125 * rttMs
+    estimator[2] = estimator[0] + k * estimator[1]
+    return estimator
+
+
+# Peer states are kept in a bounded table; the peer added first is evicted
+# when it is full, and starts again from the initial timeout.
+class CoapCongestionControl:
+    def __init__(self, size, probingRate, initialRtoMs=macros._ACK_TIMEOUT_MS):
+        self.initialRtoMs = initialRtoMs
+        # bytes per second sent on average to a peer that does not answer (rfc7252 #4.7)
+        self.probingRate = probingRate
+        self.peers = CoapBoundedTable(size)
+
+    def __len__(self):
+        return len(self.peers)
+
+    def peerState(self, peer, nowMs):
+        state = self.peers.get(peer)
+        if state is None:
+            state = CoapPeerState(self.initialRtoMs, nowMs)
+            self.peers.put(peer, state)
+        return state
+
+    # Returns the RTO of a peer, after aging it towards the initial one when it has
+    # not been updated for a while.
+    def rtoMs(self, peer, nowMs):
+        state = self.peerState(peer, nowMs)
+        idleMs = nowMs - state.updatedMs
+        if (state.rtoMs < 1000) and (idleMs > 16 * state.rtoMs):
+            state.rtoMs = min(2 * state.rtoMs, 1000)
+            state.updatedMs = nowMs
+        elif (state.rtoMs > 3000) and (idleMs > 4 * state.rtoMs):
+            state.rtoMs = (state.rtoMs + self.initialRtoMs) // 2
+            state.updatedMs = nowMs
+        return state.rtoMs
+
+    # Timeout of the next retransmission: the variable backoff factor is larger
+    # for short timeouts and smaller for long ones.
+    @staticmethod
+    def backoffMs(timeoutMs):
+        if timeoutMs < 1000:
+            return timeoutMs * 3
+        if timeoutMs > 3000:
+            return timeoutMs * 3 // 2
+        return timeoutMs * 2
+
+    # Updates the RTO of a peer with the time between the first transmission of
+    # a confirmable message and its ACK. Samples of messages retransmitted once
+    # or twice feed the weak estimator, others are ambiguous and ignored.
+    def onRttSample(self, peer, rttMs, retransmissions, nowMs):
+        state = self.peerState(peer, nowMs)
+        if retransmissions == 0:
+            state.strong = updateEstimator(state.strong, rttMs, 4)
+            rto = 0.5 * state.strong[2] + 0.5 * state.rtoMs
+        elif retransmissions <= 2:
+            state.weak = updateEstimator(state.weak, rttMs, 1)
+            rto = 0.25 * state.weak[2] + 0.75 * state.rtoMs
+        else:
+            return
+        state.rtoMs = int(min(rto, macros._MAX_RTO_MS))
+        state.updatedMs = nowMs
+
+    def onSend(self, peer, size, nowMs):
+        state = self.peerState(peer, nowMs)
+        if state.silentBytes == 0:
+            state.silentSinceMs = nowMs
+        state.silentBytes += size
+
+    def onReceive(self, peer):
+        state = self.peers.get(peer)
+        if state is not None:
+            state.silentBytes = 0
+
+    # False while a peer that did not answer within its RTO has been sent more
+    # than the probing rate on average.
+    def canSend(self, peer, nowMs):
+        state = self.peers.get(peer)
+        if (state is None) or (state.silentBytes == 0):
+            return True
+        silentMs = nowMs - state.silentSinceMs
+        return (silentMs <= state.rtoMs) or (state.silentBytes * 1000 <= self.probingRate * silentMs)
@@ -0,0 +1,31 @@
+from .coap_table import CoapBoundedTable
+
+# Remembers the recently received CON and NON messages by (peer, messageid),
+# together with the ACK/RST that was sent for them (rfc7252 #4.5).
+#
+# The cache holds at most 'size' messages. Since messages are inserted in
+# the order they arrive and expire after a fixed lifetime, the oldest one is
+# evicted when the cache is full.
+class CoapDeduplicationCache:
+    def __init__(self, size):
+        self.entries = CoapBoundedTable(size)
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Returns the entry [expiresMs, response] of a message that has
+    # already been received, or None after recording the message as new.
+    def check(self, key, nowMs, lifetimeMs):
+        entry = self.entries.get(key)
+        if (entry is not None) and (entry[0] > nowMs):
+            return entry
+
+        self.entries.put(key, [nowMs + lifetimeMs, None])
+        return None
+
+    # Stores the encoded ACK/RST sent for a received message, so that it can
+    # be sent again if the message is retransmitted.
+    def recordResponse(self, key, data):
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry[1] = data
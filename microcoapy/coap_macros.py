@@ -2,9 +2,44 @@
 _COAP_HEADER_SIZE = 4
 _COAP_OPTION_HEADER_SIZE = 1
 _COAP_PAYLOAD_MARKER = 0xFF
-_MAX_OPTION_NUM = 10
 _BUF_MAX_SIZE = 1024
 _COAP_DEFAULT_PORT = 5683
+_COAP_TOKEN_LENGTH = 4
+# rfc7252 #4.8
+_ACK_TIMEOUT_MS = 2000
+_ACK_RANDOM_FACTOR = 1.5
+_MAX_RETRANSMIT = 4
+_EXCHANGE_LIFETIME_MS = 247000
+_NON_LIFETIME_MS = 145000
+# congestion control: peers whose RTO is kept, upper limit of the RTO and PROBING_RATE in bytes/second
+_PEER_TABLE_SIZE = 16
+_MAX_RTO_MS = 60000
+_PROBING_RATE = 1
+_DEDUPLICATION_CACHE_SIZE = 32
+_RESOLVER_CACHE_SIZE = 8
+_RESOLVER_TTL_MS = 300000
+_RESOLVER_NEGATIVE_TTL_MS = 10000
+# default size of block-wise transfers, it has to fit in _BUF_MAX_SIZE with the header and options
+_BLOCK_SIZE = 512
+# CoAP over TCP: default maximum message size (options and payload) and size of the socket reads
+_TCP_MAX_MESSAGE_SIZE = 8192
+_TCP_READ_SIZE = 4096
+_RX_BUFFER_POOL_SIZE = 2
+# time given to an offloaded request handler before its request is acknowledged with an empty ACK
+_HANDLER_DEADLINE_MS = 500
+# number of packets kept by the tracer
+_TRACE_SIZE = 64
+# number of responses kept by the server response cache
+_RESPONSE_CACHE_SIZE = 16
+# default Max-Age of a response in seconds (rfc7252 #5.10.5)
+_DEFAULT_MAX_AGE = 60
+# memory used by the client cache, and the estimated memory of a response besides its options and payload
+_CLIENT_CACHE_BYTES = 4096
+_CLIENT_CACHE_ENTRY_OVERHEAD = 128
+# header and longest token, that precede the common part of messages sent to many endpoints
+_MESSAGE_HEAD_SIZE = _COAP_HEADER_SIZE + 8
+# and the 3 byte Observe option of notifications
+_NOTIFICATION_HEAD_SIZE = _MESSAGE_HEAD_SIZE + 4
 
 def enum(**enums):
     return type('Enum', (), enums)
@@ -49,6 +84,7 @@ COAP_RESPONSE_CODE = enum(
     COAP_VALID=CoapResponseCode.encode(2, 3),
     COAP_CHANGED=CoapResponseCode.encode(2, 4),
     COAP_CONTENT=CoapResponseCode.encode(2, 5),
+    COAP_CONTINUE=CoapResponseCode.encode(2, 31),
     COAP_BAD_REQUEST=CoapResponseCode.encode(4, 0),
     COAP_UNAUTHORIZED=CoapResponseCode.encode(4, 1),
     COAP_BAD_OPTION=CoapResponseCode.encode(4, 2),
@@ -56,6 +92,7 @@ COAP_RESPONSE_CODE = enum(
     COAP_NOT_FOUND=CoapResponseCode.encode(4, 4),
     COAP_METHOD_NOT_ALLOWD=CoapResponseCode.encode(4, 5),
     COAP_NOT_ACCEPTABLE=CoapResponseCode.encode(4, 6),
+    COAP_REQUEST_ENTITY_INCOMPLETE=CoapResponseCode.encode(4, 8),
     COAP_PRECONDITION_FAILED=CoapResponseCode.encode(4, 12),
     COAP_REQUEST_ENTITY_TOO_LARGE=CoapResponseCode.encode(4, 13),
     COAP_UNSUPPORTED_CONTENT_FORMAT=CoapResponseCode.encode(4, 15),
@@ -67,11 +104,24 @@ COAP_RESPONSE_CODE = enum(
     COAP_PROXYING_NOT_SUPPORTED=CoapResponseCode.encode(5, 5)
 )
 
+# signaling codes of CoAP over TCP (rfc8323 #5)
+COAP_SIGNALING_CODE = enum(
+    COAP_CSM=CoapResponseCode.encode(7, 1),
+    COAP_PING=CoapResponseCode.encode(7, 2),
+    COAP_PONG=CoapResponseCode.encode(7, 3),
+    COAP_RELEASE=CoapResponseCode.encode(7, 4),
+    COAP_ABORT=CoapResponseCode.encode(7, 5)
+)
+
+# Max-Message-Size option of a CSM signaling message
+COAP_CSM_OPTION_MAX_MESSAGE_SIZE = 2
+
 COAP_OPTION_NUMBER = enum(
     COAP_IF_MATCH=1,
     COAP_URI_HOST=3,
     COAP_E_TAG=4,
     COAP_IF_NONE_MATCH=5,
+    COAP_OBSERVE=6,
     COAP_URI_PORT=7,
     COAP_LOCATION_PATH=8,
     COAP_URI_PATH=11,
@@ -80,8 +130,12 @@ COAP_OPTION_NUMBER = enum(
     COAP_URI_QUERY=15,
     COAP_ACCEPT=17,
     COAP_LOCATION_QUERY=20,
+    COAP_BLOCK2=23,
+    COAP_BLOCK1=27,
+    COAP_SIZE2=28,
     COAP_PROXY_URI=35,
-    COAP_PROXY_SCHEME=39
+    COAP_PROXY_SCHEME=39,
+    COAP_SIZE1=60
 )
 
 COAP_CONTENT_FORMAT = enum(
@@ -0,0 +1,67 @@
+try:
+    import json
+except ImportError:
+    import ujson as json
+
+# Upper bounds, in microseconds, of the buckets of the stage histograms. The
+# last bucket counts the longer durations.
+_BUCKETS_US = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 100000)
+
+# stages of the processing of a packet
+STAGE_RECEIVE = 0
+STAGE_PARSE = 1
+STAGE_DISPATCH = 2
+STAGE_ENCODE = 3
+STAGE_SEND = 4
+_STAGES = ("receive", "parse", "dispatch", "encode", "send")
+
+
+# Counters and stage histograms of a Coap instance, see Coap.enableMetrics.
+# Histograms have fixed buckets, so recording a duration does not allocate.
+class CoapMetrics:
+    def __init__(self):
+        self.packetsIn = 0
+        self.bytesIn = 0
+        self.packetsOut = 0
+        self.bytesOut = 0
+        self.parseFailures = 0
+        self.notFound = 0
+        self.duplicates = 0
+        self.retransmissions = 0
+        # route -> number of requests
+        self.requests = {}
+        self.histograms = [[0] * (len(_BUCKETS_US) + 1) for _ in _STAGES]
+
+    def record(self, stage, durationUs):
+        histogram = self.histograms[stage]
+        for index, bound in enumerate(_BUCKETS_US):
+            if durationUs <= bound:
+                histogram[index] += 1
+                return
+        histogram[-1] += 1
+
+    def countRequest(self, route):
+        self.requests[route] = self.requests.get(route, 0) + 1
+
+    def reset(self):
+        self.__init__()
+
+    def toDict(self):
+        stages = {}
+        for stage, name in enumerate(_STAGES):
+            stages[name] = {"bucketsUs": list(_BUCKETS_US), "counts": list(self.histograms[stage])}
+        return {
+            "packetsIn": self.packetsIn,
+            "bytesIn": self.bytesIn,
+            "packetsOut": self.packetsOut,
+            "bytesOut": self.bytesOut,
+            "parseFailures": self.parseFailures,
+            "notFound": self.notFound,
+            "duplicates": self.duplicates,
+            "retransmissions": self.retransmissions,
+            "requests": dict(self.requests),
+            "stages": stages,
+        }
+
+    def toJson(self):
+        return json.dumps(self.toDict())
@@ -0,0 +1,35 @@
+from . import coap_macros as macros
+
+
+class CoapObserver:
+    def __init__(self, peer, token):
+        self.peer = peer
+        self.token = token
+        # message id of the last notification, to match a RST to it
+        self.messageid = None
+
+
+# A resource registered with Coap.addObservableResource and its observers,
+# indexed by (peer, token).
+class CoapObservableResource:
+    def __init__(self, url, producer, content_format):
+        self.url = url
+        self.producer = producer
+        self.content_format = content_format
+        self.observers = {}
+        # value of the Observe option of the last notification (24 bits)
+        self.sequence = 0
+
+    def removeObserverByMessageId(self, peer, messageid):
+        for key, observer in self.observers.items():
+            if (observer.peer == peer) and (observer.messageid == messageid):
+                del self.observers[key]
+                return
+
+    # Result of a confirmable notification: the observer is removed if it
+    # rejected the notification or never acknowledged it (rfc7641 #4.5).
+    def onNotificationResult(self, observer, packet):
+        if (packet is None) or (packet.type == macros.COAP_TYPE.COAP_RESET):
+            key = (observer.peer, observer.token)
+            if self.observers.get(key) is observer:
+                del self.observers[key]
@@ -0,0 +1,89 @@
+# Runs request callbacks in a thread pool (CPython), see Coap.offloadHandlers.
+
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import coap_macros as macros
+
+
+# A confirmable request whose callback runs in the pool.
+class CoapExchange:
+    def __init__(self, peer, messageid):
+        self.peer = peer
+        self.messageid = messageid
+        self.timer = None
+        # set when the request has been acknowledged with an empty ACK
+        self.acknowledged = False
+        # set when the callback has sent the response
+        self.responded = False
+
+
+class CoapHandlerPool:
+    def __init__(self, coap, threads, deadlineMs):
+        self.coap = coap
+        self.deadlineMs = deadlineMs
+        self.executor = ThreadPoolExecutor(threads)
+        # exchange of the request handled by the current thread
+        self.local = threading.local()
+        # written to when a handler thread schedules a timer before the one
+        # the receiving loop waits for (see Coap.waitReadable)
+        (self.wakeupReader, self.wakeupWriter) = socket.socketpair()
+        self.wakeupWriter.setblocking(False)
+        self.wakeupReader.setblocking(False)
+        if coap.timers.wakeup is None:
+            coap.timers.wakeup = self.wakeup
+
+    def wakeup(self):
+        try:
+            self.wakeupWriter.send(b"\0")
+        except OSError:
+            # already pending
+            pass
+
+    def clearWakeup(self):
+        try:
+            self.wakeupReader.recv(64)
+        except OSError:
+            pass
+
+    # Called by the receiving loop, with the lock of the Coap instance held.
+    def submit(self, callback, requestPacket, sourceIp, sourcePort):
+        # the receive buffer is reused while the callback runs
+        requestPacket.materialize()
+        exchange = None
+        if requestPacket.type == macros.COAP_TYPE.COAP_CON:
+            exchange = CoapExchange((sourceIp, sourcePort), requestPacket.messageid)
+            exchange.timer = self.coap.timers.schedule(self.deadlineMs, self.acknowledge, exchange)
+        self.executor.submit(self.run, exchange, callback, requestPacket, sourceIp, sourcePort)
+
+    def run(self, exchange, callback, requestPacket, sourceIp, sourcePort):
+        self.local.exchange = exchange
+        try:
+            callback(requestPacket, sourceIp, sourcePort)
+        except Exception as e:
+            self.coap.log("Exception in request callback: " + str(e))
+        finally:
+            self.local.exchange = None
+
+    # Timer of the deadline: the callback is still running.
+    def acknowledge(self, exchange):
+        exchange.timer = None
+        if not exchange.responded:
+            exchange.acknowledged = True
+            self.coap.sendEmptyAck(exchange.peer, exchange.messageid)
+
+    # Checks whether a packet sent by the current thread is the piggybacked
+    # response of its request, and whether that request has already been
+    # acknowledged, in which case a separate response has to be sent instead.
+    def isLateResponse(self, sockaddr, packet):
+        exchange = getattr(self.local, "exchange", None)
+        if (exchange is None) or exchange.responded:
+            return False
+        if (packet.type != macros.COAP_TYPE.COAP_ACK) or (packet.messageid != exchange.messageid) or (sockaddr != exchange.peer):
+            return False
+
+        exchange.responded = True
+        self.coap.timers.cancel(exchange.timer)
+        exchange.timer = None
+        return exchange.acknowledged
@@ -1,7 +1,12 @@
 class CoapOption:
+    __slots__ = ("number", "buffer")
+
     def __init__(self, number=-1, buffer=None):
         self.number = number
         byteBuf = bytearray()
-        if buffer is not None:
+        if isinstance(buffer, str):
+            byteBuf.extend(buffer.encode())
+        elif buffer is not None:
             byteBuf.extend(buffer)
         self.buffer = byteBuf
+
@@ -1,17 +1,41 @@
 from . import coap_macros as macros
 from .coap_option import CoapOption
 
+# The options of a packet are kept sorted by number, in flat lists of numbers
+# and of the start and end offsets of their values in a single value buffer.
+# For a received packet the value buffer is the datagram itself, for a packet
+# being built it is a bytearray the values are appended to.
 class CoapPacket:
+    __slots__ = (
+        "version",
+        "type",
+        "method",
+        "tokenLength",
+        "token",
+        "payload",
+        "messageid",
+        "content_format",
+        "query",
+        "optionNumbers",
+        "optionStarts",
+        "optionEnds",
+        "optionValues",
+    )
+
     def __init__(self):
         self.version = macros.COAP_VERSION.COAP_VERSION_UNSUPPORTED
         self.type = macros.COAP_TYPE.COAP_CON  # uint8_t
         self.method = macros.COAP_METHOD.COAP_GET  # uint8_t
+        self.tokenLength = 0
         self.token = bytearray()
         self.payload = bytearray()
         self.messageid = 0
         self.content_format = macros.COAP_CONTENT_FORMAT.COAP_NONE
         self.query = bytearray()  # uint8_t*
-        self.options = []
+        self.optionNumbers = []
+        self.optionStarts = []
+        self.optionEnds = []
+        self.optionValues = None
 
     # def __eq__(self, other):
     #     return self.toString() == other.toString()
@@ -22,17 +46,162 @@ class CoapPacket:
         #     self.options == other.options)
 
     def addOption(self, number, opt_payload):
-        if(len(self.options) >= macros._MAX_OPTION_NUM):
-            return
-        self.options.append(CoapOption(number, opt_payload))
+        values = self.writableValues()
+        start = len(values)
+        if isinstance(opt_payload, str):
+            values.extend(opt_payload.encode())
+        elif opt_payload is not None:
+            values.extend(opt_payload)
+        self.insertOption(number, start, len(values))
+
+    # Adds an unsigned integer option (e.g. Content-Format, Accept, Max-Age,
+    # Observe, Block1/Block2) in the minimum number of bytes (rfc7252 #3.2).
+    def addUintOption(self, number, value):
+        values = self.writableValues()
+        start = len(values)
+        length = 0
+        remaining = value
+        while remaining > 0:
+            length += 1
+            remaining >>= 8
+        for shift in range(8 * (length - 1), -1, -8):
+            values.append((value >> shift) & 0xFF)
+        self.insertOption(number, start, len(values))
+
+    def writableValues(self):
+        values = self.optionValues
+        if values is None:
+            values = self.optionValues = bytearray()
+        elif not isinstance(values, bytearray):
+            # values of a received packet, copy them before adding to them
+            values = self.optionValues = bytearray(values)
+        return values
+
+    def insertOption(self, number, start, end):
+        # options are mostly added in ascending order, search from the end
+        numbers = self.optionNumbers
+        i = len(numbers)
+        while (i > 0) and (numbers[i - 1] > number):
+            i -= 1
+        numbers.insert(i, number)
+        self.optionStarts.insert(i, start)
+        self.optionEnds.insert(i, end)
+
+    # The options as a list of CoapOption, for compatibility. The values are
+    # copies: changing them does not change the packet.
+    @property
+    def options(self):
+        values = self.optionValues
+        return [CoapOption(self.optionNumbers[i], values[self.optionStarts[i] : self.optionEnds[i]]) for i in range(len(self.optionNumbers))]
+
+    @options.setter
+    def options(self, options):
+        self.optionNumbers = []
+        self.optionStarts = []
+        self.optionEnds = []
+        self.optionValues = None
+        for opt in options:
+            self.addOption(opt.number, opt.buffer)
 
     def setUriHost(self, address):
         self.addOption(macros.COAP_OPTION_NUMBER.COAP_URI_HOST, address)
 
     def setUriPath(self, url):
         for subPath in url.split('/'):
-            self.addOption(macros.COAP_OPTION_NUMBER.COAP_URI_PATH, subPath)
+            if subPath != '':
+                self.addOption(macros.COAP_OPTION_NUMBER.COAP_URI_PATH, subPath)
+
+    # Returns the index of the first option with the given number, or -1.
+    # The options are sorted, so they are binary searched.
+    def findOption(self, number):
+        numbers = self.optionNumbers
+        low = 0
+        high = len(numbers)
+        while low < high:
+            middle = (low + high) >> 1
+            if numbers[middle] < number:
+                low = middle + 1
+            else:
+                high = middle
+        if (low < len(numbers)) and (numbers[low] == number):
+            return low
+        return -1
+
+    # Returns the value of the first option with the given number, or None.
+    def getOption(self, number):
+        i = self.findOption(number)
+        if i < 0:
+            return None
+        return self.optionValues[self.optionStarts[i] : self.optionEnds[i]]
+
+    # Returns the values of all the options with the given number, e.g. the
+    # segments of Uri-Path, in their order.
+    def getOptions(self, number):
+        result = []
+        i = self.findOption(number)
+        if i >= 0:
+            numbers = self.optionNumbers
+            while (i < len(numbers)) and (numbers[i] == number):
+                result.append(self.optionValues[self.optionStarts[i] : self.optionEnds[i]])
+                i += 1
+        return result
+
+    # Returns the value of an unsigned integer option, or default if the
+    # packet does not have it.
+    def getUintOption(self, number, default=None):
+        i = self.findOption(number)
+        if i < 0:
+            return default
+        values = self.optionValues
+        value = 0
+        for j in range(self.optionStarts[i], self.optionEnds[i]):
+            value = (value << 8) | values[j]
+        return value
+
+    # Returns the value of a string option (e.g. Uri-Host, Proxy-Uri) as str,
+    # or default if the packet does not have it.
+    def getStringOption(self, number, default=None):
+        value = self.getOption(number)
+        if value is None:
+            return default
+        return bytes(value).decode("utf-8")
+
+    # Returns the value of an opaque option (e.g. ETag, If-Match) as bytes,
+    # or default if the packet does not have it.
+    def getOpaqueOption(self, number, default=None):
+        value = self.getOption(number)
+        if value is None:
+            return default
+        return bytes(value)
+
+    # Turns the content_format and query fields into their options.
+    def prepareOptions(self):
+        if self.content_format != macros.COAP_CONTENT_FORMAT.COAP_NONE:
+            self.addUintOption(macros.COAP_OPTION_NUMBER.COAP_CONTENT_FORMAT, self.content_format)
+
+        if (self.query is not None) and (len(self.query) > 0):
+            self.addOption(macros.COAP_OPTION_NUMBER.COAP_URI_QUERY, self.query)
+
+    # Replaces the token, option values and payload that reference a received
+    # datagram with copies of them. The option values are copied at once.
+    def materialize(self):
+        if isinstance(self.token, memoryview):
+            self.token = bytes(self.token)
+        if isinstance(self.optionValues, memoryview):
+            if self.optionNumbers:
+                first = self.optionStarts[0]
+                self.optionValues = bytes(self.optionValues[first : self.optionEnds[-1]])
+                if first > 0:
+                    self.optionStarts = [start - first for start in self.optionStarts]
+                    self.optionEnds = [end - first for end in self.optionEnds]
+            else:
+                self.optionValues = None
+        if isinstance(self.payload, memoryview):
+            self.payload = bytes(self.payload)
 
     def toString(self):
         class_, detail = macros.CoapResponseCode.decode(self.method)
-        return "type: {}, method: {}.{:02d}, messageid: {}, payload: {}".format(macros.coapTypeToString(self.type), class_, detail, self.messageid, self.payload)
+        payload = self.payload
+        if isinstance(payload, memoryview):
+            payload = bytes(payload)
+        return "type: {}, method: {}.{:02d}, messageid: {}, payload: {}".format(macros.coapTypeToString(self.type), class_, detail, self.messageid, payload)
@@ -0,0 +1,224 @@
+from . import coap_macros as macros
+from .coap_packet import CoapPacket
+
+# Forward proxy (rfc7252 #5.7), see Coap.enableProxy.
+
+# Options of a proxied request that are not forwarded: they designate the
+# target, which is forwarded as the options of the upstream request, or are
+# answered by the proxy itself.
+_LOCAL_OPTIONS = (
+    macros.COAP_OPTION_NUMBER.COAP_URI_HOST,
+    macros.COAP_OPTION_NUMBER.COAP_E_TAG,
+    macros.COAP_OPTION_NUMBER.COAP_OBSERVE,
+    macros.COAP_OPTION_NUMBER.COAP_URI_PORT,
+    macros.COAP_OPTION_NUMBER.COAP_URI_PATH,
+    macros.COAP_OPTION_NUMBER.COAP_URI_QUERY,
+    macros.COAP_OPTION_NUMBER.COAP_PROXY_URI,
+    macros.COAP_OPTION_NUMBER.COAP_PROXY_SCHEME,
+)
+
+
+# Returns (scheme, host, port, path, query) of an absolute URI such as
+# "coap://[fd00::1]:5683/sensors/temp?unit=c", or None if it is not valid.
+def parseProxyUri(uri):
+    i = uri.find("://")
+    if i <= 0:
+        return None
+    scheme = uri[:i].lower()
+    rest = uri[i + 3:]
+
+    i = rest.find("#")
+    if i >= 0:
+        rest = rest[:i]
+    query = ""
+    i = rest.find("?")
+    if i >= 0:
+        query = rest[i + 1:]
+        rest = rest[:i]
+    path = ""
+    i = rest.find("/")
+    if i >= 0:
+        path = rest[i + 1:]
+        rest = rest[:i]
+
+    port = macros._COAP_DEFAULT_PORT
+    if rest.startswith("["):
+        # IPv6 address literal
+        i = rest.find("]")
+        if i < 0:
+            return None
+        host = rest[1:i]
+        rest = rest[i + 1:]
+        if rest and not rest.startswith(":"):
+            return None
+    else:
+        i = rest.rfind(":")
+        host = rest if i < 0 else rest[:i]
+        rest = "" if i < 0 else rest[i:]
+    if len(rest) > 1:
+        try:
+            port = int(rest[1:])
+        except ValueError:
+            return None
+    if host == "":
+        return None
+    return (scheme, host, port, path, query)
+
+
+# A request received by the proxy, waiting for the upstream response.
+class _ProxiedRequest:
+    def __init__(self, peer, packet):
+        self.peer = peer
+        self.messageid = packet.messageid
+        self.token = bytes(packet.token or b"")
+        self.type = packet.type
+        # entity tags of the responses the client already has
+        self.etags = [bytes(etag) for etag in packet.getOptions(macros.COAP_OPTION_NUMBER.COAP_E_TAG)]
+        # confirmable requests are acknowledged with an empty ACK when their
+        # response is not available right away
+        self.acknowledged = False
+        self.answered = False
+
+
+# Forwards the requests that carry a Proxy-Uri or Proxy-Scheme option to their
+# target. GET responses are kept in the client cache of the Coap instance, and
+# identical GET requests received while one is forwarded wait for its response
+# instead of being forwarded again, so the upstream load does not grow with the
+# number of clients.
+class CoapProxy:
+    def __init__(self, coap):
+        self.coap = coap
+        # client cache key -> list of _ProxiedRequest waiting for the response
+        self.inflight = {}
+
+    # Returns (scheme, host, port, path, query) of the target of a request, or None.
+    @staticmethod
+    def target(packet):
+        proxyUri = packet.getStringOption(macros.COAP_OPTION_NUMBER.COAP_PROXY_URI)
+        if proxyUri is not None:
+            return parseProxyUri(proxyUri)
+
+        host = packet.getStringOption(macros.COAP_OPTION_NUMBER.COAP_URI_HOST)
+        if host is None:
+            return None
+        return (
+            packet.getStringOption(macros.COAP_OPTION_NUMBER.COAP_PROXY_SCHEME).lower(),
+            host,
+            packet.getUintOption(macros.COAP_OPTION_NUMBER.COAP_URI_PORT, macros._COAP_DEFAULT_PORT),
+            "/".join([bytes(segment).decode() for segment in packet.getOptions(macros.COAP_OPTION_NUMBER.COAP_URI_PATH)]),
+            "&".join([bytes(segment).decode() for segment in packet.getOptions(macros.COAP_OPTION_NUMBER.COAP_URI_QUERY)]),
+        )
+
+    def handleRequest(self, requestPacket, sourceIp, sourcePort):
+        # a retransmission is answered with the ACK sent for the original
+        # request instead of being forwarded again; with discardRetransmissions
+        # it has already been discarded
+        if (not self.coap.discardRetransmissions) and self.coap.isDuplicate(requestPacket, (sourceIp, sourcePort)):
+            return
+        request = _ProxiedRequest((sourceIp, sourcePort), requestPacket)
+        target = self.target(requestPacket)
+        if target is None:
+            self.answer(request, None, macros.COAP_RESPONSE_CODE.COAP_BAD_REQUEST)
+            return
+        (scheme, host, port, path, query) = target
+        if scheme != "coap":
+            self.answer(request, None, macros.COAP_RESPONSE_CODE.COAP_PROXYING_NOT_SUPPORTED)
+            return
+
+        packet = CoapPacket()
+        packet.type = macros.COAP_TYPE.COAP_CON
+        packet.method = requestPacket.method
+        packet.payload = bytes(requestPacket.payload) if requestPacket.payload is not None else None
+        for i in range(len(requestPacket.optionNumbers)):
+            number = requestPacket.optionNumbers[i]
+            if number not in _LOCAL_OPTIONS:
+                packet.addOption(number, requestPacket.optionValues[requestPacket.optionStarts[i]:requestPacket.optionEnds[i]])
+        for segment in query.split("&"):
+            if segment != "":
+                packet.addOption(macros.COAP_OPTION_NUMBER.COAP_URI_QUERY, segment)
+
+        key = None
+        cache = self.coap.clientCache
+        if (cache is not None) and (packet.method == macros.COAP_METHOD.COAP_GET):
+            key = cache.requestKey(self.coap.resolveAddress(host, port), path, packet)
+        if key is not None:
+            waiting = self.inflight.get(key)
+            if waiting is not None:
+                # the same request is being forwarded, wait for its response
+                waiting.append(request)
+                self.acknowledge(request)
+                return
+
+        waiting = [request]
+        if key is not None:
+            self.inflight[key] = waiting
+        status = self.coap.sendEx(host, port, path, packet, lambda packet, remoteAddress: self.onResponse(key, waiting, packet))
+        if request.answered:
+            # served by the client cache
+            return
+        if status == 0:
+            self.onResponse(key, waiting, None, macros.COAP_RESPONSE_CODE.COAP_SERVICE_UNAVALIABLE)
+        else:
+            self.acknowledge(request)
+
+    def acknowledge(self, request):
+        if (request.type == macros.COAP_TYPE.COAP_CON) and not request.acknowledged:
+            request.acknowledged = True
+            self.coap.sendEmptyAck(request.peer, request.messageid)
+
+    # Answers the requests waiting for an upstream response, or for a failed
+    # upstream exchange with the given error code.
+    def onResponse(self, key, waiting, packet, errorCode=macros.COAP_RESPONSE_CODE.COAP_GATEWAY_TIMEOUT):
+        if (key is not None) and (self.inflight.get(key) is waiting):
+            del self.inflight[key]
+
+        # a cached response is only fresh for the rest of its Max-Age
+        maxAge = None
+        if (packet is not None) and (key is not None):
+            entry = self.coap.clientCache.lookup(key)
+            if (entry is not None) and (entry[1] is packet):
+                maxAge = max(0, (entry[0] - self.coap.timers.now()) // 1000)
+
+        for request in waiting:
+            if packet is None:
+                self.answer(request, None, errorCode)
+            else:
+                self.answer(request, packet, packet.method, maxAge)
+
+    def answer(self, request, upstream, code, maxAge=None):
+        request.answered = True
+        response = CoapPacket()
+        response.method = code
+        response.token = request.token
+        response.payload = None
+
+        if upstream is not None:
+            etag = upstream.getOpaqueOption(macros.COAP_OPTION_NUMBER.COAP_E_TAG)
+            valid = (code == macros.COAP_RESPONSE_CODE.COAP_CONTENT) and (etag is not None) and (etag in request.etags)
+            if valid:
+                # the client has this representation (rfc7252 #5.10.6.2)
+                response.method = macros.COAP_RESPONSE_CODE.COAP_VALID
+                response.addOption(macros.COAP_OPTION_NUMBER.COAP_E_TAG, etag)
+            else:
+                response.payload = upstream.payload
+                for i in range(len(upstream.optionNumbers)):
+                    number = upstream.optionNumbers[i]
+                    if (number != macros.COAP_OPTION_NUMBER.COAP_MAX_AGE) or (maxAge is None):
+                        response.addOption(number, upstream.optionValues[upstream.optionStarts[i]:upstream.optionEnds[i]])
+            if maxAge is not None:
+                response.addUintOption(macros.COAP_OPTION_NUMBER.COAP_MAX_AGE, maxAge)
+            elif valid:
+                maxAge = upstream.getOpaqueOption(macros.COAP_OPTION_NUMBER.COAP_MAX_AGE)
+                if maxAge is not None:
+                    response.addOption(macros.COAP_OPTION_NUMBER.COAP_MAX_AGE, maxAge)
+
+        if request.type == macros.COAP_TYPE.COAP_CON:
+            if request.acknowledged:
+                self.coap.sendSeparateResponse(request.peer, response)
+                return
+            response.type = macros.COAP_TYPE.COAP_ACK
+            response.messageid = request.messageid
+        else:
+            response.type = macros.COAP_TYPE.COAP_NONCON
+            response.messageid = self.coap.nextMessageId()
+        self.coap.sendPacketToAddress(request.peer, response)
@@ -1,8 +1,10 @@
 from . import coap_macros as macros
-from .coap_option import CoapOption
 
+# The parsing functions slice the given buffer, so when it is a memoryview the
+# token, option values and payload of the packet reference the received
+# datagram instead of being copied out of it. The options are recorded as
+# offsets into the buffer, which becomes the value buffer of the packet.
 def parseOption(packet, runningDelta, buffer, i):
-    option = CoapOption()
     headlen = 1
 
     errorMessage = (False, runningDelta, i)
@@ -52,9 +54,9 @@ def parseOption(packet, runningDelta, buffer, i):
     if endOfOptionIndex > len(buffer):
         return errorMessage
 
-    option.number = delta + runningDelta
-    option.buffer = buffer[i+1:i+1+length]
-    packet.options.append(option)
+    packet.optionNumbers.append(delta + runningDelta)
+    packet.optionStarts.append(i + 1)
+    packet.optionEnds.append(endOfOptionIndex)
 
     return (True, runningDelta + delta, endOfOptionIndex)
 
@@ -67,13 +69,16 @@ def parsePacketHeaderInfo(buffer, packet):
     packet.messageid |= 0x00FF & buffer[3]
 
 def parsePacketOptionsAndPayload(buffer, packet):
+    return parseOptionsAndPayload(buffer, packet, macros._COAP_HEADER_SIZE + packet.tokenLength)
+
+# Parses the options and the payload that start at 'index' and end with the buffer.
+def parseOptionsAndPayload(buffer, packet, index):
     bufferLen = len(buffer)
-    if (macros._COAP_HEADER_SIZE + packet.tokenLength) < bufferLen:
+    if index < bufferLen:
         delta = 0
-        bufferIndex = macros._COAP_HEADER_SIZE + packet.tokenLength
-        while (len(packet.options) < macros._MAX_OPTION_NUM) and\
-              (bufferIndex < bufferLen) and\
-              (buffer[bufferIndex] != 0xFF):
+        bufferIndex = index
+        packet.optionValues = buffer
+        while (bufferIndex < bufferLen) and (buffer[bufferIndex] != 0xFF):
             (status, delta, bufferIndex) = parseOption(packet, delta, buffer, bufferIndex)
             if status is False:
                 return False
@@ -0,0 +1,83 @@
+try:
+    import socket
+except ImportError:
+    import usocket as socket
+
+from .coap_table import CoapBoundedTable
+
+
+# True for IPv4 and IPv6 address literals, which need no resolution.
+def isNumericAddress(host):
+    if ":" in host:
+        return True
+    parts = host.split(".")
+    if len(parts) != 4:
+        return False
+    for part in parts:
+        if not part.isdigit():
+            return False
+    return True
+
+
+# Caches the socket addresses of host names, so that getaddrinfo is not called
+# for every message.
+#
+# Resolved addresses are kept for ttlMs, and host names that could not be
+# resolved for negativeTtlMs, so that sending to them does not repeat the
+# blocking lookup every time. At most 'size' of them are kept, the oldest one
+# is evicted when the cache is full. Pinned addresses never expire and do not
+# count against the size.
+class CoapResolver:
+    def __init__(self, size, ttlMs, negativeTtlMs):
+        self.ttlMs = ttlMs
+        self.negativeTtlMs = negativeTtlMs
+        # (host, port) -> [sockaddr or None, expiresMs]
+        self.entries = CoapBoundedTable(size)
+        self.pinned = {}
+
+    def __len__(self):
+        return len(self.entries) + len(self.pinned)
+
+    # Returns the socket address of (host, port), or None if the host cannot
+    # be resolved.
+    def resolve(self, host, port, nowMs):
+        key = (host, port)
+        sockaddr = self.pinned.get(key)
+        if sockaddr is not None:
+            return sockaddr
+        if isNumericAddress(host):
+            return key
+
+        entry = self.entries.get(key)
+        if (entry is not None) and (entry[1] > nowMs):
+            return entry[0]
+
+        ttlMs = self.ttlMs
+        try:
+            sockaddr = socket.getaddrinfo(host, port)[0][-1]
+        except Exception:
+            sockaddr = None
+            ttlMs = self.negativeTtlMs
+
+        if entry is not None:
+            entry[0] = sockaddr
+            entry[1] = nowMs + ttlMs
+            return sockaddr
+
+        self.entries.put(key, [sockaddr, nowMs + ttlMs])
+        return sockaddr
+
+    # Resolves (host, port) now and keeps the result until unpin is called.
+    # A socket address can also be given, to bypass the resolution.
+    def pin(self, host, port, sockaddr=None):
+        if sockaddr is None:
+            sockaddr = socket.getaddrinfo(host, port)[0][-1]
+        self.pinned[(host, port)] = sockaddr
+        return sockaddr
+
+    def unpin(self, host, port):
+        self.pinned.pop((host, port), None)
+
+    # Forgets all the resolved addresses, e.g. after a network change.
+    def clear(self):
+        self.entries.clear()
@@ -0,0 +1,177 @@
+from . import coap_macros as macros
+
+_WILDCARD = b"*"
+_PREFIX = b"**"
+
+
+# method -> callback, None as method matches any method
+class RouteHandlers(dict):
+    def __init__(self, url):
+        super().__init__()
+        # the route, as given to addRoute without empty segments
+        self.url = url
+
+
+class _RouteNode:
+    def __init__(self):
+        self.children = {}
+        # node matching any single segment
+        self.wildcard = None
+        # handlers of the route ending with "**", matching any remaining segments
+        self.prefixHandlers = None
+        self.handlers = None
+
+
+# Path trie of the resources of a server. Routes are matched against the raw
+# Uri-Path option values of a request, one segment per trie level, so
+# dispatching does not depend on the number of routes and builds no strings.
+#
+# A route segment "*" matches any single segment, and a last segment "**"
+# matches any remaining segments (including none). At each level an exact
+# segment is preferred to "*", and "*" to "**".
+class CoapRouter:
+    def __init__(self):
+        self.root = _RouteNode()
+
+    def addRoute(self, url, callback, method=None):
+        node = self.root
+        segments = [s for s in url.split("/") if s != ""]
+        route = "/".join(segments)
+        for index, segment in enumerate(segments):
+            segment = segment.encode()
+            if segment == _PREFIX and index == len(segments) - 1:
+                if node.prefixHandlers is None:
+                    node.prefixHandlers = RouteHandlers(route)
+                node.prefixHandlers[method] = callback
+                return
+            if segment == _WILDCARD:
+                if node.wildcard is None:
+                    node.wildcard = _RouteNode()
+                node = node.wildcard
+            else:
+                child = node.children.get(segment)
+                if child is None:
+                    child = node.children[segment] = _RouteNode()
+                node = child
+        if node.handlers is None:
+            node.handlers = RouteHandlers(route)
+        node.handlers[method] = callback
+
+    # Returns the RouteHandlers of a route as it was added, "*" and "**"
+    # segments being taken literally, or None.
+    def findRoute(self, url):
+        node = self.root
+        segments = [s for s in url.split("/") if s != ""]
+        for index, segment in enumerate(segments):
+            segment = segment.encode()
+            if segment == _PREFIX and index == len(segments) - 1:
+                return node.prefixHandlers
+            node = node.wildcard if segment == _WILDCARD else node.children.get(segment)
+            if node is None:
+                return None
+        return node.handlers
+
+    # Removes the callbacks of a route, for all methods.
+    def removeRoute(self, url):
+        handlers = self.findRoute(url)
+        if handlers is not None:
+            handlers.clear()
+
+    # Returns the RouteHandlers of all the routes that have callbacks.
+    def routes(self):
+        routes = []
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            for handlers in (node.handlers, node.prefixHandlers):
+                if handlers:
+                    routes.append(handlers)
+            nodes.extend(node.children.values())
+            if node.wildcard is not None:
+                nodes.append(node.wildcard)
+        return routes
+
+    # Returns the RouteHandlers (method -> callback) of the route matching the
+    # Uri-Path options of the packet, or None if there is no such route.
+    def match(self, packet):
+        segments = []
+        numbers = packet.optionNumbers
+        i = packet.findOption(macros.COAP_OPTION_NUMBER.COAP_URI_PATH)
+        while (0 <= i < len(numbers)) and (numbers[i] == macros.COAP_OPTION_NUMBER.COAP_URI_PATH):
+            start = packet.optionStarts[i]
+            end = packet.optionEnds[i]
+            i += 1
+            if start == end:
+                continue
+            segment = packet.optionValues[start:end]
+            if type(segment) is not bytes:
+                segment = bytes(segment)
+            segments.append(segment)
+        return self.matchNode(self.root, segments, 0)
+
+    # Matches segments[index:] below node. When the exact child leads to no
+    # route, the "*" child is tried, then the "**" route of the node.
+    def matchNode(self, node, segments, index):
+        if index == len(segments):
+            if node.handlers:
+                return node.handlers
+            return node.prefixHandlers or None
+
+        child = node.children.get(segments[index])
+        if child is not None:
+            handlers = self.matchNode(child, segments, index + 1)
+            if handlers is not None:
+                return handlers
+        if node.wildcard is not None:
+            handlers = self.matchNode(node.wildcard, segments, index + 1)
+            if handlers is not None:
+                return handlers
+        return node.prefixHandlers or None
+
+
+# The dict of url -> callback that Coap.callbacks used to be, kept for the code
+# that reads or changes it directly. Callbacks set through it handle all
+# methods, and a route that only has callbacks for specific methods reads as None.
+class RouteCallbacks:
+    def __init__(self, coap):
+        self.coap = coap
+
+    def __getitem__(self, url):
+        handlers = self.coap.router.findRoute(url)
+        if not handlers:
+            raise KeyError(url)
+        return handlers.get(None)
+
+    def get(self, url, default=None):
+        handlers = self.coap.router.findRoute(url)
+        if not handlers:
+            return default
+        return handlers.get(None)
+
+    def __setitem__(self, url, callback):
+        self.coap.addIncomingRequestCallback(url, callback)
+
+    def __delitem__(self, url):
+        if not self.coap.router.findRoute(url):
+            raise KeyError(url)
+        self.coap.router.removeRoute(url)
+
+    def pop(self, url, default=None):
+        callback = self.get(url, default)
+        self.coap.router.removeRoute(url)
+        return callback
+
+    def __contains__(self, url):
+        return bool(self.coap.router.findRoute(url))
+
+    def __len__(self):
+        return len(self.coap.router.routes())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [handlers.url for handlers in self.coap.router.routes()]
+
+    def items(self):
+        return [(handlers.url, handlers.get(None)) for handlers in self.coap.router.routes()]
@@ -0,0 +1,54 @@
+# A dict of at most 'size' entries, for the caches and tables that have to be
+# bounded in memory. When it is full, adding a key evicts the key that was
+# added first: nothing is recorded when an entry is used, and entries that
+# expire after a fixed time are evicted roughly in the order they expire.
+class CoapBoundedTable:
+    def __init__(self, size):
+        self.size = size
+        self.entries = {}
+        # key -> its slot in 'keys'
+        self.slots = {}
+        # the keys in the order they were added, as a ring
+        self.keys = [None] * size
+        self.index = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __getitem__(self, key):
+        return self.entries[key]
+
+    def get(self, key, default=None):
+        return self.entries.get(key, default)
+
+    # Adds or replaces the value of a key, which then counts as the newest one.
+    def put(self, key, value):
+        self.remove(key)
+        slot = self.index
+        oldKey = self.keys[slot]
+        if oldKey is not None:
+            self.remove(oldKey)
+        self.keys[slot] = key
+        self.slots[key] = slot
+        self.index = (slot + 1) % self.size
+        self.entries[key] = value
+
+    # Removes a key and returns its value, or None.
+    def remove(self, key):
+        slot = self.slots.pop(key, None)
+        if slot is None:
+            return None
+        self.keys[slot] = None
+        return self.entries.pop(key)
+
+    def clear(self):
+        self.entries = {}
+        self.slots = {}
+        self.keys = [None] * self.size
+        self.index = 0
@@ -0,0 +1,395 @@
+try:
+    import socket
+except ImportError:
+    import usocket as socket
+
+try:
+    import select
+except ImportError:
+    import uselect as select
+
+from . import coap_macros as macros
+from .coap_metrics import STAGE_SEND
+from .coap_packet import CoapPacket
+from .coap_reader import parseOptionsAndPayload
+from .coap_timer import ticksDiff
+from .coap_timer import ticksMs
+from .coap_timer import ticksUs
+from .coap_trace import TRACE_IN
+from .coap_trace import TRACE_OUT
+from .coap_writer import encodeInto
+from .microcoapy import Coap
+
+# CoAP over TCP (rfc8323)
+#
+# A frame is the message without type and message id, prefixed with the length
+# of its options and payload:
+#
+#   Len (4 bits) | TKL (4 bits) | Extended Length (0-4 bytes) | Code | Token | Options | Payload
+#
+# Messages are encoded like for UDP, then their header is rewritten in place
+# into the frame header, so all the sending paths share the encoder.
+
+# Max-Message-Size of a peer until its CSM says otherwise (rfc8323 #5.3.1)
+_DEFAULT_PEER_MAX_MESSAGE_SIZE = 1152
+
+
+# Rewrites the header of the message encoded in buffer[start:end] into the
+# header of a frame. The token, options and payload stay in place and the frame
+# header ends where the message header ended. Returns the index the frame
+# starts at, or -1 if there is no room in front of the message.
+def writeFrameHead(buffer, start, end):
+    tokenLength = buffer[start] & 0x0F
+    code = buffer[start + 1]
+    bodyStart = start + macros._COAP_HEADER_SIZE + tokenLength
+    length = end - bodyStart
+
+    if length < 13:
+        (nibble, extended, extendedLength) = (length, 0, 0)
+    elif length < 269:
+        (nibble, extended, extendedLength) = (13, length - 13, 1)
+    elif length < 65805:
+        (nibble, extended, extendedLength) = (14, length - 269, 2)
+    else:
+        (nibble, extended, extendedLength) = (15, length - 65805, 4)
+
+    frameStart = bodyStart - tokenLength - 2 - extendedLength
+    if frameStart < 0:
+        return -1
+    buffer[bodyStart - tokenLength - 1] = code
+    for i in range(extendedLength):
+        buffer[frameStart + extendedLength - i] = (extended >> (8 * i)) & 0xFF
+    buffer[frameStart] = (nibble << 4) | tokenLength
+    return frameStart
+
+
+# Reassembles the frames of a connection from the data read from it, which
+# may end in the middle of a frame.
+class CoapFrameReader:
+    def __init__(self, maxMessageSize):
+        self.maxMessageSize = maxMessageSize
+        self.buffer = bytearray()
+        # start of the first frame not read yet
+        self.start = 0
+        # length of the frame of the last packet returned
+        self.frameLength = 0
+
+    def feed(self, data):
+        if self.start > 0:
+            # only the beginning of a frame is left, move it to the front
+            self.buffer = self.buffer[self.start:]
+            self.start = 0
+        self.buffer.extend(data)
+
+    # Returns the packet of the next complete frame, or None if more data is
+    # needed. Raises ValueError if the frame is invalid or too large.
+    # zeroCopy: the token, option values and payload are memoryview slices of
+    # a copy of the frame that is owned by the packet.
+    def nextPacket(self, zeroCopy=False):
+        buffer = self.buffer
+        i = self.start
+        available = len(buffer) - i
+        if available < 2:
+            return None
+
+        length = buffer[i] >> 4
+        tokenLength = buffer[i] & 0x0F
+        extendedLength = 0
+        if length >= 13:
+            extendedLength = 1 << (length - 13)
+        headLength = 2 + extendedLength + tokenLength
+        if available < headLength:
+            return None
+
+        if length == 13:
+            length = buffer[i + 1] + 13
+        elif length == 14:
+            length = ((buffer[i + 1] << 8) | buffer[i + 2]) + 269
+        elif length == 15:
+            length = ((buffer[i + 1] << 24) | (buffer[i + 2] << 16) | (buffer[i + 3] << 8) | buffer[i + 4]) + 65805
+        if (tokenLength > 8) or (length > self.maxMessageSize):
+            raise ValueError("Invalid frame")
+        end = i + headLength + length
+        if len(buffer) < end:
+            return None
+
+        # copied once through a temporary view, the buffer stays resizable
+        frame = bytes(memoryview(buffer)[i:end])
+        self.start = end
+        self.frameLength = end - i
+        if zeroCopy:
+            frame = memoryview(frame)
+
+        packet = CoapPacket()
+        packet.type = macros.COAP_TYPE.COAP_NONCON
+        packet.messageid = 0
+        packet.method = frame[1 + extendedLength]
+        packet.tokenLength = tokenLength
+        packet.token = frame[headLength - tokenLength:headLength]
+        if not parseOptionsAndPayload(frame, packet, headLength):
+            raise ValueError("Invalid options")
+        return packet
+
+
+class CoapTcpConnection:
+    def __init__(self, sock, peer, maxMessageSize):
+        self.sock = sock
+        self.peer = peer
+        self.reader = CoapFrameReader(maxMessageSize)
+        self.peerMaxMessageSize = _DEFAULT_PEER_MAX_MESSAGE_SIZE
+
+
+# Exposes the connections through the socket functions used by Coap: messages
+# are written to the connection of their destination.
+class _ConnectionSocket:
+    def __init__(self, coap):
+        self.coap = coap
+
+    def sendto(self, bytes, address):
+        connection = self.coap.connections.get(address)
+        if connection is None:
+            return 0
+        try:
+            connection.sock.sendall(bytes)
+        except OSError:
+            self.coap.closeConnection(connection)
+            raise
+        return len(bytes)
+
+    def setblocking(self, flag):
+        pass
+
+    def close(self):
+        pass
+
+
+# A Coap that exchanges messages over TCP connections instead of UDP datagrams.
+# One connection is kept per peer: it is opened by the first message sent to
+# the peer, or accepted by 'start', and is used until it is closed by either
+# side. The transport is reliable, so messages are neither acknowledged nor
+# retransmitted, and messages up to maxMessageSize bytes can be exchanged.
+class TcpCoap(Coap):
+    def __init__(self, maxMessageSize=macros._TCP_MAX_MESSAGE_SIZE):
+        super().__init__()
+        self.maxMessageSize = maxMessageSize
+        self.maxRetransmit = 0
+        # with room for the message header and token in front of the options
+        self.txBuffer = bytearray(maxMessageSize + macros._MESSAGE_HEAD_SIZE)
+        self.txView = memoryview(self.txBuffer)
+        self.listener = None
+        # peer -> CoapTcpConnection
+        self.connections = {}
+        # polled sockets, and their file descriptors on CPython, -> connection or listener
+        self.pollTargets = {}
+        self.poller = select.poll()
+        self.sock = _ConnectionSocket(self)
+
+    # Listens for connections on the given port.
+    def start(self, port=macros._COAP_DEFAULT_PORT):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("", port))
+        self.listener.listen(8)
+        self.register(self.listener, self.listener)
+
+    def stop(self):
+        for connection in list(self.connections.values()):
+            self.closeConnection(connection)
+        if self.listener is not None:
+            self.unregister(self.listener)
+            self.listener.close()
+            self.listener = None
+
+    # Custom sockets are not supported: messages are written to the connection
+    # of each peer.
+    def setCustomSocket(self, custom_socket):
+        self.log("Custom sockets are not supported over TCP")
+
+    def register(self, sock, target):
+        self.poller.register(sock, select.POLLIN)
+        self.pollTargets[sock] = target
+        if hasattr(sock, "fileno"):
+            self.pollTargets[sock.fileno()] = target
+
+    def unregister(self, sock):
+        self.poller.unregister(sock)
+        self.pollTargets.pop(sock, None)
+        if hasattr(sock, "fileno"):
+            self.pollTargets.pop(sock.fileno(), None)
+
+    # Opens the connection to a peer ahead of sending to it.
+    def connect(self, ip, port):
+        sockaddr = self.resolveAddress(ip, port)
+        if sockaddr is None:
+            return None
+        return self.connectionTo(sockaddr)
+
+    # Returns the connection of a peer, opening it if needed, or None.
+    def connectionTo(self, sockaddr):
+        connection = self.connections.get(sockaddr)
+        if connection is not None:
+            return connection
+        family = socket.AF_INET6 if ":" in str(sockaddr[0]) else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.connect(sockaddr)
+        except OSError as e:
+            self.log("Cannot connect to " + str(sockaddr) + ": " + str(e))
+            sock.close()
+            return None
+        return self.addConnection(sock, sockaddr)
+
+    def addConnection(self, sock, peer):
+        if hasattr(socket, "TCP_NODELAY"):
+            # requests and responses are written in one piece
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = CoapTcpConnection(sock, peer, self.maxMessageSize)
+        self.connections[peer] = connection
+        self.register(sock, connection)
+        # each side starts with a CSM (rfc8323 #5.3)
+        self.sendSignal(connection, macros.COAP_SIGNALING_CODE.COAP_CSM)
+        return connection
+
+    # Closes a connection. Its outstanding requests fail, their callbacks are
+    # called with None.
+    def closeConnection(self, connection):
+        if self.connections.get(connection.peer) is not connection:
+            return
+        del self.connections[connection.peer]
+        self.unregister(connection.sock)
+        connection.sock.close()
+        for transaction in list(self.transactionsByMessageId.values()):
+            if transaction.peer == connection.peer:
+                self.expireTransaction(transaction)
+
+    # Sends a signaling message, encoded apart from the transmission buffer,
+    # which may hold a message being sent.
+    def sendSignal(self, connection, code, token=b""):
+        packet = CoapPacket()
+        packet.method = code
+        packet.token = token
+        packet.messageid = 0
+        if code == macros.COAP_SIGNALING_CODE.COAP_CSM:
+            packet.addUintOption(macros.COAP_CSM_OPTION_MAX_MESSAGE_SIZE, self.maxMessageSize)
+        buffer = bytearray(32)
+        end = encodeInto(buffer, packet)
+        start = writeFrameHead(buffer, 0, end)
+        try:
+            connection.sock.sendall(memoryview(buffer)[start:end])
+        except OSError:
+            self.closeConnection(connection)
+
+    def handleSignal(self, connection, packet):
+        code = packet.method
+        if code == macros.COAP_SIGNALING_CODE.COAP_CSM:
+            connection.peerMaxMessageSize = packet.getUintOption(macros.COAP_CSM_OPTION_MAX_MESSAGE_SIZE, _DEFAULT_PEER_MAX_MESSAGE_SIZE)
+        elif code == macros.COAP_SIGNALING_CODE.COAP_PING:
+            self.sendSignal(connection, macros.COAP_SIGNALING_CODE.COAP_PONG, bytes(packet.token or b""))
+        elif (code == macros.COAP_SIGNALING_CODE.COAP_RELEASE) or (code == macros.COAP_SIGNALING_CODE.COAP_ABORT):
+            self.closeConnection(connection)
+
+    # Writes the message in the bytes [start, end) of the transmission buffer
+    # to the connection of the peer as a frame. The type and code are traced
+    # from the message header, which the frame header overwrites.
+    def sendBuffer(self, sockaddr, end, messageid, start=0):
+        connection = self.connectionTo(sockaddr)
+        if connection is None:
+            return 0
+        type = (self.txBuffer[start] >> 4) & 0x03
+        code = self.txBuffer[start + 1]
+        start = writeFrameHead(self.txBuffer, start, end)
+        if (start < 0) or (end - start > connection.peerMaxMessageSize):
+            self.log("Message too large for: " + str(sockaddr))
+            return 0
+
+        metrics = self.metrics
+        if metrics is not None:
+            startUs = ticksUs()
+        try:
+            connection.sock.sendall(self.txView[start:end])
+        except OSError as e:
+            self.log("Exception while sending to " + str(sockaddr) + ": " + str(e))
+            self.closeConnection(connection)
+            return 0
+        if metrics is not None:
+            metrics.record(STAGE_SEND, ticksDiff(ticksUs(), startUs))
+            metrics.packetsOut += 1
+            metrics.bytesOut += end - start
+        if self.tracer is not None:
+            self.tracer.record(ticksMs(), TRACE_OUT, sockaddr, messageid, type, code, end - start)
+        return messageid
+
+    # Messages have no message id over TCP, responses are matched to their
+    # request by token only, so every request gets a token of its own.
+    def requestToken(self, token, callback):
+        return token or self.newToken()
+
+    # Notifications are not acknowledged over TCP.
+    def notify(self, url, confirmable=False):
+        return super().notify(url, False)
+
+    # Accepts new connections and reads the available data of the others.
+    # Returns True if a message has been processed.
+    def loop(self, blocking=True):
+        if self.timers.heap:
+            with self.lock:
+                self.timers.run()
+        if not self.pollTargets:
+            return False
+
+        # a blocking poll waits for the next timer at most
+        timeoutMs = 0
+        if blocking:
+            with self.lock:
+                timeoutMs = self.timers.nextDelayMs()
+        status = False
+        for event in self.poller.poll(timeoutMs):
+            target = self.pollTargets.get(event[0])
+            if target is None:
+                continue
+            if target is self.listener:
+                (sock, peer) = self.listener.accept()
+                self.addConnection(sock, peer)
+            elif self.receive(target):
+                status = True
+        return status
+
+    def receive(self, connection):
+        try:
+            data = connection.sock.recv(macros._TCP_READ_SIZE)
+        except OSError:
+            data = None
+        if not data:
+            self.closeConnection(connection)
+            return False
+
+        connection.reader.feed(data)
+        status = False
+        with self.lock:
+            while connection.peer in self.connections:
+                try:
+                    packet = connection.reader.nextPacket(self.zeroCopyDecode)
+                except ValueError:
+                    self.log("Invalid frame from: " + str(connection.peer))
+                    self.sendSignal(connection, macros.COAP_SIGNALING_CODE.COAP_ABORT)
+                    self.closeConnection(connection)
+                    break
+                if packet is None:
+                    break
+                if self.processFrame(connection, packet, connection.reader.frameLength):
+                    status = True
+        return status
+
+    def processFrame(self, connection, packet, length):
+        if self.metrics is not None:
+            self.metrics.packetsIn += 1
+            self.metrics.bytesIn += length
+        if self.tracer is not None:
+            self.tracer.record(ticksMs(), TRACE_IN, connection.peer, packet.messageid, packet.type, packet.method, length)
+        if (packet.method >> 5) == 7:
+            self.handleSignal(connection, packet)
+            return False
+        if packet.method == macros.COAP_METHOD.COAP_EMPTY_MESSAGE:
+            # empty messages carry nothing over TCP (rfc8323 #3.4)
+            return False
+        return self.dispatchPacket(packet, connection.peer)
@@ -0,0 +1,15 @@
+from . import coap_macros as macros
+from .coap_writer import writePacketOptions
+
+class CoapRequestTemplate:
+    def __init__(self, ip, port, sockaddr, packet):
+        self.ip = ip
+        self.port = port
+        self.sockaddr = sockaddr
+        self.type = packet.type
+        self.method = packet.method
+
+        # the options are encoded only once, when the template is created
+        buffer = bytearray(macros._BUF_MAX_SIZE)
+        length = writePacketOptions(buffer, packet, 0)
+        self.options = bytes(buffer[:length])
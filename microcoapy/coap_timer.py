@@ -0,0 +1,122 @@
+try:
+    import time
+except ImportError:
+    import utime as time
+
+try:
+    import heapq
+except ImportError:
+    import uheapq as heapq
+
+# Millisecond ticks. MicroPython provides wrapping ticks, on CPython a
+# monotonic clock is used instead.
+if hasattr(time, "ticks_ms"):
+    ticksMs = time.ticks_ms
+    ticksDiff = time.ticks_diff
+    ticksAdd = time.ticks_add
+else:
+    def ticksMs():
+        return int(time.monotonic() * 1000)
+
+    def ticksDiff(a, b):
+        return a - b
+
+    def ticksAdd(a, b):
+        return a + b
+
+# Microsecond ticks, for measurements.
+if hasattr(time, "ticks_us"):
+    ticksUs = time.ticks_us
+else:
+    def ticksUs():
+        return time.perf_counter_ns() // 1000
+
+if hasattr(time, "sleep_ms"):
+    sleepMs = time.sleep_ms
+else:
+    def sleepMs(ms):
+        time.sleep(ms / 1000)
+
+
+# A min-heap of timers. Scheduling and expiring a timer costs O(log n).
+# Cancelled timers stay in the heap until the heap gets compacted.
+#
+# Deadlines are kept in an internal millisecond counter that does not
+# wrap, so the heap order remains valid when the system ticks overflow.
+class CoapTimerQueue:
+    def __init__(self):
+        self.heap = []
+        self.sequence = 0
+        self.cancelled = 0
+        # set while run calls the callbacks, which must not see the heap replaced
+        self.running = False
+        self.lastTicks = ticksMs()
+        self.elapsedMs = 0
+        # optional function called when a timer is scheduled before all the
+        # others, so that a loop sleeping until the first timer can wake up
+        self.wakeup = None
+
+    def now(self):
+        ticks = ticksMs()
+        self.elapsedMs += ticksDiff(ticks, self.lastTicks)
+        self.lastTicks = ticks
+        return self.elapsedMs
+
+    def __len__(self):
+        return len(self.heap) - self.cancelled
+
+    # Schedules callback(arg) to be called in delayMs milliseconds.
+    # Returns the timer, which can be passed to cancel.
+    def schedule(self, delayMs, callback, arg):
+        self.sequence += 1
+        # a list rather than a tuple, so that it can be cancelled in place
+        timer = [self.now() + delayMs, self.sequence, callback, arg]
+        heapq.heappush(self.heap, timer)
+        if (self.wakeup is not None) and (self.heap[0] is timer):
+            self.wakeup()
+        return timer
+
+    def cancel(self, timer):
+        if (timer is None) or (timer[2] is None):
+            return
+        timer[2] = None
+        timer[3] = None
+        self.cancelled += 1
+        if not self.running:
+            self.compact()
+
+    # Drops the cancelled timers when they are the majority of the heap.
+    def compact(self):
+        if self.cancelled > 16 and self.cancelled * 2 > len(self.heap):
+            self.heap = [t for t in self.heap if t[2] is not None]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+
+    # Milliseconds until the next timer expires, -1 if there is none.
+    def nextDelayMs(self):
+        while self.heap and self.heap[0][2] is None:
+            heapq.heappop(self.heap)
+            self.cancelled -= 1
+        if not self.heap:
+            return -1
+        return max(0, self.heap[0][0] - self.now())
+
+    # Calls the callbacks of all expired timers.
+    def run(self):
+        now = self.now()
+        heap = self.heap
+        self.running = True
+        try:
+            while heap and heap[0][0] <= now:
+                timer = heapq.heappop(heap)
+                callback = timer[2]
+                if callback is None:
+                    self.cancelled -= 1
+                    continue
+                arg = timer[3]
+                timer[2] = None
+                timer[3] = None
+                callback(arg)
+        finally:
+            self.running = False
+        self.compact()
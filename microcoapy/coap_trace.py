@@ -0,0 +1,69 @@
+from . import coap_macros as macros
+
+TRACE_IN = 0
+TRACE_OUT = 1
+_DIRECTIONS = ("in", "out")
+
+# fields of an event
+_TIME = 0
+_DIRECTION = 1
+_PEER = 2
+_MESSAGE_ID = 3
+_TYPE = 4
+_CODE = 5
+_LENGTH = 6
+
+
+# Records the packets received and sent by a Coap instance in a ring buffer of
+# 'size' events, see Coap.enableTracing. The events are preallocated and only
+# their fields are overwritten, so recording neither allocates nor formats
+# anything; the events are formatted when they are dumped.
+class CoapTracer:
+    def __init__(self, size):
+        self.events = [[0, 0, None, 0, 0, 0, 0] for _ in range(size)]
+        self.index = 0
+        self.count = 0
+
+    # type and code are None for a datagram that could not be parsed.
+    def record(self, timeMs, direction, peer, messageid, type, code, length):
+        event = self.events[self.index]
+        event[_TIME] = timeMs
+        event[_DIRECTION] = direction
+        event[_PEER] = peer
+        event[_MESSAGE_ID] = messageid
+        event[_TYPE] = type
+        event[_CODE] = code
+        event[_LENGTH] = length
+        self.index = (self.index + 1) % len(self.events)
+        if self.count < len(self.events):
+            self.count += 1
+
+    # Records a message from its encoded header.
+    def recordBuffer(self, timeMs, direction, peer, buffer, start, end):
+        self.record(timeMs, direction, peer, (buffer[start + 2] << 8) | buffer[start + 3], (buffer[start] >> 4) & 0x03, buffer[start + 1], end - start)
+
+    def clear(self):
+        self.index = 0
+        self.count = 0
+
+    # Returns the recorded events, oldest first, as tuples
+    # (timeMs, direction, peer, messageid, type, code, length).
+    def snapshot(self):
+        size = len(self.events)
+        first = (self.index - self.count) % size
+        return [tuple(self.events[(first + i) % size]) for i in range(self.count)]
+
+    # Returns the recorded events, oldest first, as lines of text.
+    def dump(self):
+        lines = []
+        for timeMs, direction, peer, messageid, type, code, length in self.snapshot():
+            if code is None:
+                lines.append("{} {} {} invalid, length: {}".format(timeMs, _DIRECTIONS[direction], peer, length))
+                continue
+            class_, detail = macros.CoapResponseCode.decode(code)
+            lines.append(
+                "{} {} {} type: {}, code: {}.{:02d}, messageid: {}, length: {}".format(
+                    timeMs, _DIRECTIONS[direction], peer, macros.coapTypeToString(type), class_, detail, messageid, length
+                )
+            )
+        return lines
@@ -0,0 +1,25 @@
+# An outstanding request waiting for its response.
+class CoapTransaction:
+    __slots__ = ("peer", "messageid", "token", "confirmable", "callback", "timer", "data", "timeoutMs", "retransmissions", "separate", "isRequest", "cacheKey", "sentMs")
+
+    def __init__(self, peer, messageid, token, confirmable, callback):
+        self.peer = peer
+        self.messageid = messageid
+        # bytes, so that it can be used as a key of the transaction table
+        self.token = token
+        self.confirmable = confirmable
+        self.callback = callback
+        # the pending retransmission or expiration timer
+        self.timer = None
+        # encoded message and retransmission state of a confirmable request (rfc7252 #4.2)
+        self.data = None
+        self.timeoutMs = 0
+        self.retransmissions = 0
+        # set when an empty ACK has been received and a separate response is expected
+        self.separate = False
+        # False for messages that only wait for an ACK/RST, like notifications
+        self.isRequest = True
+        # key of the request in the client cache, for cacheable GET requests
+        self.cacheKey = None
+        # time of the first transmission, until the RTT is measured (congestion control)
+        self.sentMs = None
@@ -0,0 +1,95 @@
+# Multi-process server mode (CPython on Linux and BSDs only).
+#
+# Worker processes are forked after the routes have been registered, so each
+# one inherits the same route table, and every worker binds its own socket to
+# the same port with SO_REUSEPORT. The kernel distributes the incoming
+# datagrams among them.
+
+import multiprocessing
+import multiprocessing.connection
+import select
+import socket
+import time
+
+# counters kept per worker, in this order
+_STATS = ("received", "processed")
+
+
+def _runWorker(coap, port, counters, index):
+    coap.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    coap.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    coap.sock.bind(("", port))
+    # written to when a timer is scheduled before the one the worker waits
+    # for, e.g. from a handler thread
+    (wakeupReader, wakeupWriter) = socket.socketpair()
+    wakeupWriter.setblocking(False)
+    coap.timers.wakeup = lambda: _wakeup(wakeupWriter)
+    base = index * len(_STATS)
+    while True:
+        # wake up for the timers even if nothing is received
+        delayMs = coap.timers.nextDelayMs()
+        readable = select.select([coap.sock, wakeupReader], [], [], None if delayMs < 0 else delayMs / 1000)[0]
+        if wakeupReader in readable:
+            wakeupReader.recv(64)
+        if coap.sock in readable:
+            counters[base] += 1
+            if coap.loop(False):
+                counters[base + 1] += 1
+        else:
+            coap.timers.run()
+
+
+def _wakeup(writer):
+    try:
+        writer.send(b"\0")
+    except OSError:
+        # already pending
+        pass
+
+
+class CoapWorkerPool:
+    def __init__(self, coap, count):
+        self.coap = coap
+        self.count = count
+        self.processes = []
+        # each worker is the only writer of its own counters
+        self.counters = None
+
+    def start(self, port):
+        context = multiprocessing.get_context("fork")
+        self.counters = context.Array("q", self.count * len(_STATS), lock=False)
+        for index in range(self.count):
+            process = context.Process(target=_runWorker, args=(self.coap, port, self.counters, index), daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+    # Blocks until a worker exits, or for timeoutS seconds when none is running,
+    # so that the main loop of the calling process does not spin.
+    def wait(self, timeoutS):
+        sentinels = [process.sentinel for process in self.processes if process.is_alive()]
+        if sentinels:
+            multiprocessing.connection.wait(sentinels)
+        else:
+            time.sleep(timeoutS)
+
+    # Returns the counters summed over all workers, and those of each worker
+    # under "workers".
+    def stats(self):
+        total = {}
+        workers = []
+        for index in range(self.count):
+            worker = {}
+            for i, name in enumerate(_STATS):
+                worker[name] = self.counters[index * len(_STATS) + i] if self.counters is not None else 0
+                total[name] = total.get(name, 0) + worker[name]
+            worker["alive"] = (index < len(self.processes)) and self.processes[index].is_alive()
+            workers.append(worker)
+        total["workers"] = workers
+        return total
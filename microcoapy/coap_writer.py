@@ -1,6 +1,13 @@
 from .coap_macros import _BUF_MAX_SIZE
+from .coap_macros import _COAP_HEADER_SIZE
+from .coap_macros import _COAP_PAYLOAD_MARKER
+from .coap_macros import COAP_OPTION_NUMBER
 from .coap_macros import COAP_VERSION
 
+# The writing functions encode a packet into a caller owned buffer (bytearray or
+# memoryview) starting at the given index and return the index right after the
+# written data, or 0 if the data does not fit.
+
 def CoapOptionDelta(v):
     if v < 13:
         return (0xFF & v)
@@ -9,60 +16,156 @@ def CoapOptionDelta(v):
     else:
         return 14
 
-def writePacketHeaderInfo(buffer, packet):
-    # make coap packet base header
-    buffer.append(COAP_VERSION.COAP_VERSION_1 << 6)
-    buffer[0] |= (packet.type & 0x03) << 4
+def toBytes(value):
+    # strings are accepted as option values and payloads
+    if isinstance(value, str):
+        return value.encode()
+    return value
+
+def writePacketHeaderInfo(buffer, packet, index=0):
     # max: 8 bytes of tokens, if token length is greater, it is ignored
     tokenLength = 0
     if (packet.token is not None) and (len(packet.token) <= 0x0F):
         tokenLength = len(packet.token)
 
-    buffer[0] |= (tokenLength & 0x0F)
-    buffer.append(packet.method)
-    buffer.append(packet.messageid >> 8)
-    buffer.append(packet.messageid & 0xFF)
+    if (index + _COAP_HEADER_SIZE + tokenLength) > len(buffer):
+        return 0
 
-    if tokenLength > 0:
-        buffer.extend(packet.token)
-
-def writePacketOptions(buffer, packet):
-    runningDelta = 0
-    # make option header
-    # Process the options in ascending order of option number for correct delta computation.
-    for opt in sorted(packet.options, key=lambda x: x.number):
-        if (opt is None) or (opt.buffer is None) or (len(opt.buffer) == 0):
-            continue
+    # make coap packet base header
+    buffer[index] = (COAP_VERSION.COAP_VERSION_1 << 6) | ((packet.type & 0x03) << 4) | (tokenLength & 0x0F)
+    buffer[index + 1] = packet.method
+    buffer[index + 2] = (packet.messageid >> 8) & 0xFF
+    buffer[index + 3] = packet.messageid & 0xFF
+    index += _COAP_HEADER_SIZE
 
-        optBufferLen = len(opt.buffer)
+    if tokenLength > 0:
+        buffer[index:index + tokenLength] = packet.token
+        index += tokenLength
+    return index
 
-        if (len(buffer) + 5 + optBufferLen) >= _BUF_MAX_SIZE:
-            return 0
+# Writes an option whose value is values[start:end].
+def writeOption(buffer, index, optDelta, values, start, end):
+    valueLen = end - start
+    if (index + 5 + valueLen) > len(buffer):
+        return 0
 
-        optdelta = opt.number - runningDelta
-        delta = CoapOptionDelta(optdelta)
-        length = CoapOptionDelta(optBufferLen)
+    if (optDelta < 13) and (valueLen < 13):
+        # the common case, a single byte header
+        buffer[index] = (optDelta << 4) | valueLen
+        index += 1
+    else:
+        delta = CoapOptionDelta(optDelta)
+        length = CoapOptionDelta(valueLen)
 
-        buffer.append(0xFF & (delta << 4 | length))
+        buffer[index] = 0xFF & (delta << 4 | length)
+        index += 1
         if (delta == 13):
-            buffer.append(optdelta - 13)
+            buffer[index] = optDelta - 13
+            index += 1
         elif (delta == 14):
-            buffer.append((optdelta - 269) >> 8)
-            buffer.append(0xFF & (optdelta - 269))
+            buffer[index] = (optDelta - 269) >> 8
+            buffer[index + 1] = 0xFF & (optDelta - 269)
+            index += 2
 
         if (length == 13):
-            buffer.append(optBufferLen - 13)
+            buffer[index] = valueLen - 13
+            index += 1
         elif (length == 14):
-            buffer.append(optBufferLen >> 8)
-            buffer.append(0xFF & (optBufferLen - 269))
+            buffer[index] = (valueLen - 269) >> 8
+            buffer[index + 1] = 0xFF & (valueLen - 269)
+            index += 2
 
-        buffer.extend(opt.buffer)
-        runningDelta = opt.number
+    buffer[index:index + valueLen] = values[start:end]
+    return index + valueLen
+
+# previousNumber: number of an option already written before these options
+def writePacketOptions(buffer, packet, index, previousNumber=0):
+    runningDelta = previousNumber
+    numbers = packet.optionNumbers
+    starts = packet.optionStarts
+    ends = packet.optionEnds
+    values = packet.optionValues
+    # the options are kept sorted by number, as needed for the deltas
+    for i in range(len(numbers)):
+        number = numbers[i]
+        index = writeOption(buffer, index, number - runningDelta, values, starts[i], ends[i])
+        if index == 0:
+            return 0
+        runningDelta = number
+    return index
 
-def writePacketPayload(buffer, packet):
+def writePayload(buffer, index, payload):
     # make payload
-    if (packet.payload is not None) and (len(packet.payload)):
-        if (len(buffer) + 1 + len(packet.payload)) >= _BUF_MAX_SIZE:
+    if (payload is not None) and (len(payload)):
+        payload = toBytes(payload)
+        payloadLen = len(payload)
+        if (index + 1 + payloadLen) > len(buffer):
             return 0
-        buffer.append(0xFF)
-        buffer.extend(packet.payload)
+        buffer[index] = _COAP_PAYLOAD_MARKER
+        buffer[index + 1:index + 1 + payloadLen] = payload
+        index += 1 + payloadLen
+    return index
+
+def writePacketPayload(buffer, packet, index):
+    return writePayload(buffer, index, packet.payload)
+
+# Encodes the packet into buffer and returns the length of the encoded message,
+# or 0 if it does not fit into the buffer.
+def encodeInto(buffer, packet):
+    index = writePacketHeaderInfo(buffer, packet)
+    if index == 0:
+        return 0
+    index = writePacketOptions(buffer, packet, index)
+    if index == 0:
+        return 0
+    return writePacketPayload(buffer, packet, index)
+
+def encode(packet):
+    buffer = bytearray(_BUF_MAX_SIZE)
+    length = encodeInto(buffer, packet)
+    return buffer[:length]
+
+# Encodes a request from a CoapRequestTemplate: only the message id, the token
+# and the payload are written, the options are copied as they have been encoded.
+def encodeTemplateInto(buffer, template, messageid, token, payload):
+    tokenLength = 0
+    if (token is not None) and (len(token) <= 0x0F):
+        tokenLength = len(token)
+    optionsLength = len(template.options)
+
+    index = _COAP_HEADER_SIZE + tokenLength + optionsLength
+    if index > len(buffer):
+        return 0
+
+    buffer[0] = (COAP_VERSION.COAP_VERSION_1 << 6) | ((template.type & 0x03) << 4) | tokenLength
+    buffer[1] = template.method
+    buffer[2] = (messageid >> 8) & 0xFF
+    buffer[3] = messageid & 0xFF
+    if tokenLength > 0:
+        buffer[_COAP_HEADER_SIZE:_COAP_HEADER_SIZE + tokenLength] = token
+    buffer[index - optionsLength:index] = template.options
+
+    return writePayload(buffer, index, payload)
+
+# Writes the header and the token of a message so that they end at 'end',
+# where its options and payload have been written. Returns the index the
+# message starts at.
+def writeMessageHead(buffer, end, type, code, messageid, token):
+    tokenLength = len(token)
+    start = end - tokenLength - _COAP_HEADER_SIZE
+    buffer[start] = (COAP_VERSION.COAP_VERSION_1 << 6) | ((type & 0x03) << 4) | tokenLength
+    buffer[start + 1] = code
+    buffer[start + 2] = (messageid >> 8) & 0xFF
+    buffer[start + 3] = messageid & 0xFF
+    buffer[end - tokenLength:end] = token
+    return start
+
+# Same as writeMessageHead for a notification, whose first option is a 3 byte
+# Observe option.
+def writeNotificationHead(buffer, end, type, code, messageid, token, sequence):
+    # Observe option: delta 6, length 3
+    buffer[end - 4] = (COAP_OPTION_NUMBER.COAP_OBSERVE << 4) | 3
+    buffer[end - 3] = (sequence >> 16) & 0xFF
+    buffer[end - 2] = (sequence >> 8) & 0xFF
+    buffer[end - 1] = sequence & 0xFF
+    return writeMessageHead(buffer, end - 4, type, code, messageid, token)
@@ -9,38 +9,148 @@ except ImportError:
     import uos as os
 
 try:
-    import time
+    import select
 except ImportError:
-    import utime as time
+    import uselect as select
 
 import binascii
 
 from . import coap_macros as macros
+from .coap_block import BlockSource
+from .coap_block import CoapBlockTransfer
+from .coap_block import blockSizeToSzx
+from .coap_block import decodeBlock
+from .coap_block import encodeBlock
+from .coap_block import transferKey
+from .coap_block import writeToSink
+from .coap_cache import CoapClientCache
+from .coap_cache import CoapResponseCache
+from .coap_congestion import CoapCongestionControl
+from .coap_dedup import CoapDeduplicationCache
+from .coap_metrics import CoapMetrics
+from .coap_metrics import STAGE_DISPATCH
+from .coap_metrics import STAGE_ENCODE
+from .coap_metrics import STAGE_PARSE
+from .coap_metrics import STAGE_RECEIVE
+from .coap_metrics import STAGE_SEND
+from .coap_observe import CoapObservableResource
+from .coap_observe import CoapObserver
 from .coap_packet import CoapPacket
+from .coap_proxy import CoapProxy
 
 from .coap_reader import parsePacketHeaderInfo
 from .coap_reader import parsePacketOptionsAndPayload
-from .coap_writer import writePacketHeaderInfo
+from .coap_resolver import CoapResolver
+from .coap_router import CoapRouter
+from .coap_router import RouteCallbacks
+from .coap_template import CoapRequestTemplate
+from .coap_timer import CoapTimerQueue
+from .coap_timer import sleepMs
+from .coap_timer import ticksDiff
+from .coap_timer import ticksMs
+from .coap_timer import ticksUs
+from .coap_trace import CoapTracer
+from .coap_trace import TRACE_IN
+from .coap_trace import TRACE_OUT
+from .coap_transaction import CoapTransaction
+from .coap_writer import encodeInto
+from .coap_writer import encodeTemplateInto
+from .coap_writer import writeMessageHead
+from .coap_writer import writeNotificationHead
 from .coap_writer import writePacketOptions
-from .coap_writer import writePacketPayload
+from .coap_writer import writePayload
+
+
+# Used as the lock of a Coap instance while request handlers run inline.
+class _NoLock:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+
+# Serializes a method that uses the transmission buffer, the transaction table
+# or the timers with the handler threads (see offloadHandlers).
+def synchronized(method):
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
 
 
 class Coap:
     TRANSMISSION_STATE = macros.enum(STATE_IDLE=0, STATE_SEPARATE_ACK_RECEIVED_WAITING_DATA=1)
 
-    def __init__(self):
+    # workers: number of server processes started by 'start', see startWorkers.
+    def __init__(self, workers=1):
         self.debug = True
         self.sock = None
-        self.callbacks = {}
+        self.workers = workers
+        self.workerPool = None
+        # set by offloadHandlers
+        self.handlerPool = None
+        self.lock = _NoLock()
+        self.router = CoapRouter()
         self.responseCallback = None
         self.port = 0
         self.isServer = False
         self.state = self.TRANSMISSION_STATE.STATE_IDLE
         self.isCustomSocket = False
+        self.messageId = None
+        # outstanding requests, indexed by (peer, token) and by (peer, messageid)
+        self.transactions = {}
+        self.transactionsByMessageId = {}
+        self.outstandingPerPeer = {}
+        # maximum number of outstanding requests per peer, 0 for no limit (rfc7252 #4.7)
+        self.nstart = 0
+        # retransmission of confirmable requests (rfc7252 #4.2), maxRetransmit = 0 disables it
+        self.ackTimeoutMs = macros._ACK_TIMEOUT_MS
+        self.ackRandomFactor = macros._ACK_RANDOM_FACTOR
+        self.maxRetransmit = macros._MAX_RETRANSMIT
+        # CoapCongestionControl, set by enableCongestionControl
+        self.congestionControl = None
+        self.timers = CoapTimerQueue()
+        # state of the block-wise transfers served, by transferKey
+        self.blockReceptions = {}
+        self.blockProductions = {}
+        # url -> CoapObservableResource
+        self.observableResources = {}
+        # outgoing packets are encoded into this buffer, allocated once per instance
+        self.txBuffer = bytearray(macros._BUF_MAX_SIZE)
+        self.txView = memoryview(self.txBuffer)
 
-        # beta flags
+        # Incoming datagrams are received into these buffers in turn, when the
+        # socket provides recvfrom_into. Zero-copy decoded packets reference
+        # them, so they stay valid until as many datagrams have been received.
+        # They are allocated by the first recvfrom_into.
+        self.rxBuffers = None
+        self.rxIndex = 0
+
+        # When enabled, the token, payload and option values of incoming packets
+        # are memoryview slices of the received datagram instead of copies.
+        # Handlers that need to keep or decode a value should call bytes() on it.
+        self.zeroCopyDecode = False
+
+        # When enabled, retransmitted CON and NON messages are not processed again.
+        # The ACK/RST that was sent for the original message is sent again instead.
         self.discardRetransmissions = False
-        self.lastPacketStr = ""
+        self.deduplicationCache = CoapDeduplicationCache(macros._DEDUPLICATION_CACHE_SIZE)
+
+        # CoapMetrics, set by enableMetrics
+        self.metrics = None
+        # CoapTracer, set by enableTracing
+        self.tracer = None
+        # CoapResponseCache, set by cacheResource
+        self.responseCache = None
+        # CoapClientCache, set by enableClientCache
+        self.clientCache = None
+        # CoapProxy, set by enableProxy
+        self.proxy = None
+
+        # Socket addresses of host names. Address literals are used as they are.
+        self.resolver = CoapResolver(macros._RESOLVER_CACHE_SIZE, macros._RESOLVER_TTL_MS, macros._RESOLVER_NEGATIVE_TTL_MS)
 
     def log(self, s):
         if self.debug:
@@ -49,12 +159,41 @@ class Coap:
     # Create and initialize a new UDP socket to listen to.
     # port: the local port to be used.
     def start(self, port=macros._COAP_DEFAULT_PORT):
+        if (self.workers > 1) and self.startWorkers(port):
+            return
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.bind(("", port))
 
+    # Starts 'workers' server processes that share the port with SO_REUSEPORT
+    # (CPython on Linux and BSDs). The request callbacks have to be added
+    # before, since each worker is forked with a copy of them. The calling
+    # process does not receive anything itself. Returns False if the platform
+    # does not support it, in which case a single socket is used.
+    def startWorkers(self, port):
+        try:
+            from .coap_workers import CoapWorkerPool
+        except ImportError:
+            self.log("Worker processes are not supported on this platform")
+            return False
+        if not hasattr(socket, "SO_REUSEPORT"):
+            self.log("SO_REUSEPORT is not supported on this platform")
+            return False
+        self.workerPool = CoapWorkerPool(self, self.workers)
+        self.workerPool.start(port)
+        return True
+
+    # Counters of the worker processes, summed and per worker.
+    def workerStats(self):
+        if self.workerPool is None:
+            return None
+        return self.workerPool.stats()
+
     # Stop and destroy the socket that has been created by
     # a previous call of 'start' function
     def stop(self):
+        if self.workerPool is not None:
+            self.workerPool.stop()
+            self.workerPool = None
         if self.sock is not None:
             self.sock.close()
             self.sock = None
@@ -65,59 +204,135 @@ class Coap:
     # Note: This overrides the automatic socket that has been created
     # by the 'start' function.
     # The custom socket must support functions:
-    # * socket.sendto(bytes, address)
+    # * socket.sendto(bytes, address) (bytes is a memoryview of the encoded packet)
     # * socket.recvfrom(bufsize)
+    # * socket.recvfrom_into(buffer) (optional, used instead of recvfrom when present)
     # * socket.setblocking(flag)
     def setCustomSocket(self, custom_socket):
         self.stop()
         self.isCustomSocket = True
         self.sock = custom_socket
 
-    def addIncomingRequestCallback(self, requestUrl, callback):
-        self.callbacks[requestUrl] = callback
+    # requestUrl: path of the resource, where a "*" segment matches any single
+    # segment and a last "**" segment matches any remaining segments.
+    # method: COAP_METHOD the callback handles, None for all methods. Requests
+    # with a method that has no callback get a 4.05 response.
+    def addIncomingRequestCallback(self, requestUrl, callback, method=None):
+        self.router.addRoute(requestUrl, callback, method)
         self.isServer = True
 
+    # The request callbacks by url, as a dict-like view of the routes, for the
+    # code written when they were kept in a dict.
+    @property
+    def callbacks(self):
+        return RouteCallbacks(self)
+
+    # The address is resolved with the lock held: the resolver cache and the
+    # timer clock are shared with the receiving loop and handler threads.
+    @synchronized
     def sendPacket(self, ip, port, coapPacket):
-        if coapPacket.content_format != macros.COAP_CONTENT_FORMAT.COAP_NONE:
-            optionBuffer = bytearray(2)
-            optionBuffer[0] = (coapPacket.content_format & 0xFF00) >> 8
-            optionBuffer[1] = coapPacket.content_format & 0x00FF
-            coapPacket.addOption(macros.COAP_OPTION_NUMBER.COAP_CONTENT_FORMAT, optionBuffer)
+        sockaddr = self.resolveAddress(ip, port)
+        if sockaddr is None:
+            return 0
+        return self.sendPacketToAddress(sockaddr, coapPacket)
+
+    @synchronized
+    def sendPacketToAddress(self, sockaddr, coapPacket):
+        if (self.responseCache is not None) and self.responseCache.pending:
+            self.storeResponse(sockaddr, coapPacket)
+
+        if (self.handlerPool is not None) and self.handlerPool.isLateResponse(sockaddr, coapPacket):
+            return self.sendSeparateResponse(sockaddr, coapPacket)
+
+        length = self.encodePacket(coapPacket)
+        if length == 0:
+            return 0
+
+        status = self.sendBuffer(sockaddr, length, coapPacket.messageid)
+        # the proxy deduplicates the requests it forwards in any case
+        if (self.discardRetransmissions or (self.proxy is not None)) and (status != 0) and (coapPacket.type >= macros.COAP_TYPE.COAP_ACK):
+            self.deduplicationCache.recordResponse((sockaddr, coapPacket.messageid), bytes(self.txView[:length]))
+        return status
+
+    # Sends the response of a request that has already been acknowledged with
+    # an empty ACK as a confirmable message of its own (rfc7252 #5.2.2).
+    def sendSeparateResponse(self, sockaddr, coapPacket):
+        coapPacket.type = macros.COAP_TYPE.COAP_CON
+        coapPacket.messageid = self.nextMessageId()
+        length = self.encodePacket(coapPacket)
+        if length == 0:
+            return 0
+
+        transaction = self.beginTransaction(sockaddr, coapPacket.messageid, coapPacket.token, coapPacket.type, None, False)
+        return self.sendTransaction(transaction, length)
+
+    # Runs the request callbacks in 'threads' threads instead of the receiving
+    # loop (CPython). A confirmable request whose callback has not sent its
+    # response within deadlineMs is acknowledged with an empty ACK, and the
+    # response is then sent as a separate confirmable message.
+    def offloadHandlers(self, threads=4, deadlineMs=macros._HANDLER_DEADLINE_MS):
+        from .coap_offload import CoapHandlerPool
+        import threading
 
-        if (coapPacket.query is not None) and (len(coapPacket.query) > 0):
-            coapPacket.addOption(macros.COAP_OPTION_NUMBER.COAP_URI_QUERY, coapPacket.query)
+        self.lock = threading.RLock()
+        self.handlerPool = CoapHandlerPool(self, threads, deadlineMs)
 
-        buffer = bytearray()
-        writePacketHeaderInfo(buffer, coapPacket)
+    # Encodes the packet into the transmission buffer and returns its length.
+    def encodePacket(self, coapPacket):
+        metrics = self.metrics
+        if metrics is not None:
+            startUs = ticksUs()
+        coapPacket.prepareOptions()
 
-        writePacketOptions(buffer, coapPacket)
+        length = encodeInto(self.txBuffer, coapPacket)
+        if length == 0:
+            self.log("Packet does not fit in the transmission buffer")
+        if metrics is not None:
+            metrics.record(STAGE_ENCODE, ticksDiff(ticksUs(), startUs))
+        return length
 
-        writePacketPayload(buffer, coapPacket)
+    # Returns the socket address of (ip, port), or None if it cannot be resolved.
+    def resolveAddress(self, ip, port):
+        sockaddr = self.resolver.resolve(ip, port, self.timers.now())
+        if sockaddr is None:
+            self.log("Cannot resolve: " + str(ip))
+        return sockaddr
 
+    # Resolves endpoints, given as (host, port) tuples, ahead of sending to them.
+    def preResolve(self, endpoints):
+        for host, port in endpoints:
+            self.resolveAddress(host, port)
+
+    # Sends the bytes [start, end) of the transmission buffer.
+    # Returns the message id on success, 0 otherwise.
+    def sendBuffer(self, sockaddr, end, messageid, start=0):
         status = 0
+        metrics = self.metrics
+        if metrics is not None:
+            startUs = ticksUs()
         try:
-            sockaddr = (ip, port)
-            try:
-                sockaddr = socket.getaddrinfo(ip, port)[0][-1]
-            except Exception as e:
-                pass
+            status = self.sock.sendto(self.txView[start:end], sockaddr)
 
-            status = self.sock.sendto(buffer, sockaddr)
+            if metrics is not None:
+                metrics.record(STAGE_SEND, ticksDiff(ticksUs(), startUs))
+                metrics.packetsOut += 1
+                metrics.bytesOut += end - start
+            if self.tracer is not None:
+                self.tracer.recordBuffer(ticksMs(), TRACE_OUT, sockaddr, self.txBuffer, start, end)
 
             if status > 0:
-                status = coapPacket.messageid
+                status = messageid
 
-            self.log("Packet sent. messageid: " + str(status))
+            if self.debug:
+                self.log("Packet sent. messageid: " + str(status))
         except Exception as e:
+            # e.g. a host name that could not be resolved
             status = 0
-            print("Exception while sending packet...")
-            import sys
-
-            sys.print_exception(e)
+            self.log("Exception while sending packet: " + str(e))
 
         return status
 
-    def send(self, ip, port, url, type, method, token, payload, content_format, query_option):
+    def send(self, ip, port, url, type, method, token, payload, content_format, query_option, callback=None):
         packet = CoapPacket()
         packet.type = type
         packet.method = method
@@ -126,18 +341,253 @@ class Coap:
         packet.content_format = content_format
         packet.query = query_option
 
-        return self.sendEx(ip, port, url, packet)
+        return self.sendEx(ip, port, url, packet, callback)
+
+    # callback: optional function(packet, remoteAddress) called with the response
+    # of this request, or with None as packet if no response arrived in time.
+    # If not provided, the responseCallback is used.
+    @synchronized
+    def sendEx(self, ip, port, url, packet, callback=None):
+        sockaddr = self.resolveAddress(ip, port)
+        if sockaddr is None:
+            return 0
+
+        cacheKey = None
+        if (self.clientCache is not None) and (packet.method == macros.COAP_METHOD.COAP_GET):
+            cacheKey = self.clientCache.requestKey(sockaddr, url, packet)
+            entry = None if cacheKey is None else self.clientCache.lookup(cacheKey)
+            if entry is not None:
+                if entry[0] > self.timers.now():
+                    # fresh response, nothing is sent
+                    if callback is None:
+                        callback = self.responseCallback
+                    if callback is not None:
+                        callback(entry[1], sockaddr)
+                    return entry[1].messageid
+                # revalidate the stale response (rfc7252 #5.6.2)
+                etag = entry[1].getOption(macros.COAP_OPTION_NUMBER.COAP_E_TAG)
+                if etag is not None:
+                    packet.addOption(macros.COAP_OPTION_NUMBER.COAP_E_TAG, etag)
+
+        if not self.canStartTransaction(sockaddr):
+            self.log("NSTART limit reached for: " + str(sockaddr))
+            return 0
 
-    def sendEx(self, ip, port, url, packet):
         self.state = self.TRANSMISSION_STATE.STATE_IDLE
-        # messageId field: 16bit -> 0-65535
-        # urandom to generate 2 bytes
-        randBytes = os.urandom(2)
-        packet.messageid = (randBytes[0] << 8) | randBytes[1]
+        packet.messageid = self.nextMessageId()
+        packet.token = self.requestToken(packet.token, callback)
         packet.setUriHost(ip)
         packet.setUriPath(url)
 
-        return self.sendPacket(ip, port, packet)
+        length = self.encodePacket(packet)
+        if length == 0:
+            return 0
+
+        transaction = self.beginTransaction(sockaddr, packet.messageid, packet.token, packet.type, callback)
+        transaction.cacheKey = cacheKey
+        return self.sendTransaction(transaction, length)
+
+    # Caches the responses of GET requests for their Max-Age, using at most
+    # about maxBytes of memory. Requests for a fresh response are answered
+    # from the cache, stale responses are revalidated with their ETag.
+    def enableClientCache(self, maxBytes=macros._CLIENT_CACHE_BYTES):
+        if self.clientCache is None:
+            self.clientCache = CoapClientCache(maxBytes)
+        return self.clientCache
+
+    def disableClientCache(self):
+        self.clientCache = None
+
+    # Acts as a forward proxy for the requests with a Proxy-Uri or Proxy-Scheme
+    # option, for the "coap" scheme. GET responses are cached in the client
+    # cache, of maxBytes, and identical GET requests are forwarded once while
+    # their response is awaited.
+    def enableProxy(self, maxBytes=macros._CLIENT_CACHE_BYTES):
+        self.enableClientCache(maxBytes)
+        if self.proxy is None:
+            self.proxy = CoapProxy(self)
+        self.isServer = True
+        return self.proxy
+
+    def newToken(self):
+        return bytearray(os.urandom(macros._COAP_TOKEN_LENGTH))
+
+    # The token of a request: a token is needed to match the response to the
+    # callback of its request, so one is generated if none was given.
+    def requestToken(self, token, callback):
+        if (callback is not None) and not token:
+            return self.newToken()
+        return token
+
+    def canStartTransaction(self, peer):
+        if (self.congestionControl is not None) and not self.congestionControl.canSend(peer, self.timers.now()):
+            self.log("PROBING_RATE limit reached for: " + str(peer))
+            return False
+        return (self.nstart <= 0) or (self.outstandingPerPeer.get(peer, 0) < self.nstart)
+
+    # Adapts the retransmission timeout of confirmable messages to the round
+    # trip time measured for each peer (CoCoA), limits the outstanding
+    # requests per peer to nstart and the data sent to a peer that does not
+    # answer to probingRate bytes per second on average.
+    def enableCongestionControl(self, nstart=1, probingRate=macros._PROBING_RATE):
+        self.nstart = nstart
+        if self.congestionControl is None:
+            self.congestionControl = CoapCongestionControl(macros._PEER_TABLE_SIZE, probingRate, self.ackTimeoutMs)
+        self.congestionControl.probingRate = probingRate
+        return self.congestionControl
+
+    def disableCongestionControl(self):
+        self.congestionControl = None
+        self.nstart = 0
+
+    # isRequest: False for messages that only wait for an ACK/RST, like
+    # notifications, which are neither matched by token nor count for NSTART.
+    def beginTransaction(self, peer, messageid, token, type, callback, isRequest=True):
+        transaction = CoapTransaction(peer, messageid, bytes(token or b""), type == macros.COAP_TYPE.COAP_CON, callback)
+        transaction.isRequest = isRequest
+        self.transactionsByMessageId[(peer, messageid)] = transaction
+        if isRequest:
+            self.transactions[(peer, transaction.token)] = transaction
+            self.outstandingPerPeer[peer] = self.outstandingPerPeer.get(peer, 0) + 1
+        return transaction
+
+    # Sends the message of a transaction that has just begun, found in the bytes
+    # [start, end) of the transmission buffer. The transaction is ended if the
+    # message could not be sent, also when sending raises.
+    def sendTransaction(self, transaction, end, start=0):
+        status = 0
+        try:
+            status = self.sendBuffer(transaction.peer, end, transaction.messageid, start)
+        finally:
+            if status == 0:
+                self.endTransaction(transaction)
+            else:
+                self.armTransaction(transaction, end, start)
+        return status
+
+    # Starts the timer of a transaction whose message has just been sent. The
+    # message is expected to be found in the bytes [start, end) of the
+    # transmission buffer.
+    def armTransaction(self, transaction, end, start=0):
+        if transaction.confirmable and self.maxRetransmit > 0:
+            transaction.data = bytes(self.txView[start:end])
+            # initial timeout: random between ACK_TIMEOUT and ACK_TIMEOUT * ACK_RANDOM_FACTOR
+            timeoutMs = self.ackTimeoutMs
+            congestionControl = self.congestionControl
+            if congestionControl is not None:
+                # the RTO of the peer instead of ACK_TIMEOUT
+                nowMs = self.timers.now()
+                transaction.sentMs = nowMs
+                timeoutMs = congestionControl.rtoMs(transaction.peer, nowMs)
+                congestionControl.onSend(transaction.peer, end - start, nowMs)
+            transaction.timeoutMs = int(timeoutMs * (1 + (self.ackRandomFactor - 1) * os.urandom(1)[0] / 255))
+            transaction.timer = self.timers.schedule(transaction.timeoutMs, self.retransmit, transaction)
+        else:
+            lifetime = macros._EXCHANGE_LIFETIME_MS if transaction.confirmable else macros._NON_LIFETIME_MS
+            transaction.timer = self.timers.schedule(lifetime, self.expireTransaction, transaction)
+
+    def retransmit(self, transaction):
+        if transaction.retransmissions >= self.maxRetransmit:
+            self.log("No ACK received for messageid: " + str(transaction.messageid))
+            self.expireTransaction(transaction)
+            return
+
+        transaction.retransmissions += 1
+        if self.congestionControl is not None:
+            transaction.timeoutMs = self.congestionControl.backoffMs(transaction.timeoutMs)
+            self.congestionControl.onSend(transaction.peer, len(transaction.data), self.timers.now())
+        else:
+            transaction.timeoutMs *= 2
+        self.log("Retransmitting messageid: " + str(transaction.messageid))
+        if self.metrics is not None:
+            self.metrics.retransmissions += 1
+            self.metrics.packetsOut += 1
+            self.metrics.bytesOut += len(transaction.data)
+        if self.tracer is not None:
+            self.tracer.recordBuffer(ticksMs(), TRACE_OUT, transaction.peer, transaction.data, 0, len(transaction.data))
+        try:
+            self.sock.sendto(transaction.data, transaction.peer)
+        except Exception as e:
+            self.log("Exception while retransmitting packet: " + str(e))
+        transaction.timer = self.timers.schedule(transaction.timeoutMs, self.retransmit, transaction)
+
+    # Ends a transaction whose response did not arrive in time.
+    def expireTransaction(self, transaction):
+        self.endTransaction(transaction)
+        if transaction.callback is not None:
+            transaction.callback(None, transaction.peer)
+
+    def endTransaction(self, transaction):
+        self.timers.cancel(transaction.timer)
+        transaction.timer = None
+        transaction.data = None
+        peer = transaction.peer
+        if self.transactionsByMessageId.get((peer, transaction.messageid)) is transaction:
+            del self.transactionsByMessageId[(peer, transaction.messageid)]
+        if not transaction.isRequest:
+            return
+        if self.transactions.get((peer, transaction.token)) is transaction:
+            del self.transactions[(peer, transaction.token)]
+        count = self.outstandingPerPeer.get(peer, 0) - 1
+        if count > 0:
+            self.outstandingPerPeer[peer] = count
+        else:
+            self.outstandingPerPeer.pop(peer, None)
+
+    # Stops waiting for the response of a request.
+    def cancelTransaction(self, peer, token):
+        transaction = self.transactions.get((peer, bytes(token or b"")))
+        if transaction is not None:
+            self.endTransaction(transaction)
+
+    # messageId field: 16bit -> 0-65535
+    # Starts from a random value and is incremented for every new message (rfc7252 #4.4)
+    def nextMessageId(self):
+        if self.messageId is None:
+            # urandom to generate 2 bytes
+            randBytes = os.urandom(2)
+            self.messageId = (randBytes[0] << 8) | randBytes[1]
+        self.messageId = (self.messageId + 1) & 0xFFFF
+        return self.messageId
+
+    # Encodes the header and the options of a request once, so that sending it
+    # again only needs the message id, token and payload to be written.
+    def compileRequest(
+        self, ip, port, url, method=macros.COAP_METHOD.COAP_POST, type=macros.COAP_TYPE.COAP_CON, content_format=macros.COAP_CONTENT_FORMAT.COAP_NONE, query_option=None
+    ):
+        packet = CoapPacket()
+        packet.type = type
+        packet.method = method
+        packet.content_format = content_format
+        packet.query = query_option
+        packet.setUriHost(ip)
+        packet.setUriPath(url)
+        packet.prepareOptions()
+
+        return CoapRequestTemplate(ip, port, self.resolveAddress(ip, port), packet)
+
+    @synchronized
+    def sendTemplate(self, template, payload=None, token=bytearray(), callback=None):
+        if template.sockaddr is None:
+            # not resolved when the template was made
+            template.sockaddr = self.resolveAddress(template.ip, template.port)
+            if template.sockaddr is None:
+                return 0
+        if not self.canStartTransaction(template.sockaddr):
+            self.log("NSTART limit reached for: " + str(template.sockaddr))
+            return 0
+
+        self.state = self.TRANSMISSION_STATE.STATE_IDLE
+        messageid = self.nextMessageId()
+        token = self.requestToken(token, callback)
+
+        length = encodeTemplateInto(self.txBuffer, template, messageid, token, payload)
+        if length == 0:
+            self.log("Packet does not fit in the transmission buffer")
+            return 0
+
+        transaction = self.beginTransaction(template.sockaddr, messageid, token, template.type, callback)
+        return self.sendTransaction(transaction, length)
 
     # to be tested
     def sendResponse(self, ip, port, messageid, payload, method, content_format, token):
@@ -152,28 +602,83 @@ class Coap:
 
         return self.sendPacket(ip, port, packet)
 
+    def sendEmptyAck(self, sockaddr, messageid):
+        packet = CoapPacket()
+        packet.type = macros.COAP_TYPE.COAP_ACK
+        packet.method = macros.COAP_METHOD.COAP_EMPTY_MESSAGE
+        packet.token = None
+        packet.messageid = messageid
+        return self.sendPacketToAddress(sockaddr, packet)
+
+    # Sends the same request to many endpoints, given as (ip, port) tuples. The
+    # options and the payload are encoded once; only the header and the token
+    # are written for each endpoint. Uri-Host is not sent, so the servers use
+    # their address as the default host (rfc7252 #5.10.1). If a callback is
+    # given, it is called with the response, or None, of each endpoint, which
+    # is identified by the remote address argument. Returns the message id
+    # of the request sent to each endpoint, or 0 where sending failed.
+    @synchronized
+    def sendMany(self, endpoints, url, packet, callback=None):
+        # the options are added to a copy, so that the packet can be sent again
+        common = CoapPacket()
+        common.optionNumbers = list(packet.optionNumbers)
+        common.optionStarts = list(packet.optionStarts)
+        common.optionEnds = list(packet.optionEnds)
+        if packet.optionValues is not None:
+            common.optionValues = bytearray(packet.optionValues)
+        common.content_format = packet.content_format
+        common.query = packet.query
+        common.payload = packet.payload
+        common.setUriPath(url)
+        common.prepareOptions()
+        start = macros._MESSAGE_HEAD_SIZE
+        end = self.encodeCommonPart(common, start)
+        if end == 0:
+            return [0] * len(endpoints)
+
+        # the token only has to be unique per endpoint, so one is enough for all
+        token = bytes(self.requestToken(packet.token, callback) or b"")
+
+        self.state = self.TRANSMISSION_STATE.STATE_IDLE
+        results = []
+        for ip, port in endpoints:
+            sockaddr = self.resolveAddress(ip, port)
+            if sockaddr is None:
+                results.append(0)
+                continue
+            if not self.canStartTransaction(sockaddr):
+                self.log("NSTART limit reached for: " + str(sockaddr))
+                results.append(0)
+                continue
+
+            messageid = self.nextMessageId()
+            messageStart = writeMessageHead(self.txBuffer, start, packet.type, packet.method, messageid, token)
+            transaction = self.beginTransaction(sockaddr, messageid, token, packet.type, callback)
+            results.append(self.sendTransaction(transaction, end, messageStart))
+        return results
+
     # Confirmable
-    def get(self, ip, port, url, token=bytearray()):
+    def get(self, ip, port, url, token=bytearray(), callback=None):
         return self.send(
-            ip, port, url, macros.COAP_TYPE.COAP_CON, macros.COAP_METHOD.COAP_GET, token, None, macros.COAP_CONTENT_FORMAT.COAP_NONE, None
+            ip, port, url, macros.COAP_TYPE.COAP_CON, macros.COAP_METHOD.COAP_GET, token, None, macros.COAP_CONTENT_FORMAT.COAP_NONE, None, callback
         )
 
     def put(
-        self, ip, port, url, payload=bytearray(), query_option=None, content_format=macros.COAP_CONTENT_FORMAT.COAP_NONE, token=bytearray()
+        self, ip, port, url, payload=bytearray(), query_option=None, content_format=macros.COAP_CONTENT_FORMAT.COAP_NONE, token=bytearray(), callback=None
     ):
         return self.send(
-            ip, port, url, macros.COAP_TYPE.COAP_CON, macros.COAP_METHOD.COAP_PUT, token, payload, content_format, query_option
+            ip, port, url, macros.COAP_TYPE.COAP_CON, macros.COAP_METHOD.COAP_PUT, token, payload, content_format, query_option, callback
         )
 
     def post(
-        self, ip, port, url, payload=bytearray(), query_option=None, content_format=macros.COAP_CONTENT_FORMAT.COAP_NONE, token=bytearray()
+        self, ip, port, url, payload=bytearray(), query_option=None, content_format=macros.COAP_CONTENT_FORMAT.COAP_NONE, token=bytearray(), callback=None
     ):
         return self.send(
-            ip, port, url, macros.COAP_TYPE.COAP_CON, macros.COAP_METHOD.COAP_POST, token, payload, content_format, query_option
+            ip, port, url, macros.COAP_TYPE.COAP_CON, macros.COAP_METHOD.COAP_POST, token, payload, content_format, query_option, callback
         )
 
     # non Confirmable
-    def getNonConf(self, ip, port, url, token=bytearray()):
+    def getNonConf(self, ip, port, url, token=bytearray(), callback=None):
         return self.send(
             ip,
             port,
@@ -184,139 +689,690 @@ class Coap:
             None,
             macros.COAP_CONTENT_FORMAT.COAP_NONE,
             None,
+            callback,
         )
 
     def putNonConf(
-        self, ip, port, url, payload=bytearray(), query_option=None, content_format=macros.COAP_CONTENT_FORMAT.COAP_NONE, token=bytearray()
+        self, ip, port, url, payload=bytearray(), query_option=None, content_format=macros.COAP_CONTENT_FORMAT.COAP_NONE, token=bytearray(), callback=None
     ):
         return self.send(
-            ip, port, url, macros.COAP_TYPE.COAP_NONCON, macros.COAP_METHOD.COAP_PUT, token, payload, content_format, query_option
+            ip, port, url, macros.COAP_TYPE.COAP_NONCON, macros.COAP_METHOD.COAP_PUT, token, payload, content_format, query_option, callback
         )
 
     def postNonConf(
-        self, ip, port, url, payload=bytearray(), query_option=None, content_format=macros.COAP_CONTENT_FORMAT.COAP_NONE, token=bytearray()
+        self, ip, port, url, payload=bytearray(), query_option=None, content_format=macros.COAP_CONTENT_FORMAT.COAP_NONE, token=bytearray(), callback=None
     ):
         return self.send(
-            ip, port, url, macros.COAP_TYPE.COAP_NONCON, macros.COAP_METHOD.COAP_POST, token, payload, content_format, query_option
+            ip, port, url, macros.COAP_TYPE.COAP_NONCON, macros.COAP_METHOD.COAP_POST, token, payload, content_format, query_option, callback
+        )
+
+    # Block-wise transfers (rfc7959)
+    #
+    # Downloads a resource with Block2 into sink, a function or an object with a
+    # write function that gets the payload of each block. callback is called
+    # with the last response, or with None as packet if the transfer failed.
+    def getBlockwise(self, ip, port, url, sink, callback=None, blockSize=macros._BLOCK_SIZE):
+        transfer = CoapBlockTransfer(self, ip, port, url, macros.COAP_METHOD.COAP_GET, None, sink, callback, blockSize, macros.COAP_CONTENT_FORMAT.COAP_NONE)
+        return transfer.start()
+
+    # Uploads a representation with Block1. source can be a bytes-like object, a
+    # file-like object or an iterable of bytes chunks (e.g. a generator), and it
+    # is read one block at a time.
+    def putBlockwise(self, ip, port, url, source, callback=None, content_format=macros.COAP_CONTENT_FORMAT.COAP_NONE, blockSize=macros._BLOCK_SIZE):
+        transfer = CoapBlockTransfer(self, ip, port, url, macros.COAP_METHOD.COAP_PUT, source, None, callback, blockSize, content_format)
+        return transfer.start()
+
+    def postBlockwise(self, ip, port, url, source, callback=None, content_format=macros.COAP_CONTENT_FORMAT.COAP_NONE, blockSize=macros._BLOCK_SIZE):
+        transfer = CoapBlockTransfer(self, ip, port, url, macros.COAP_METHOD.COAP_POST, source, None, callback, blockSize, content_format)
+        return transfer.start()
+
+    # To be called by a request callback to receive a representation uploaded
+    # with Block1. The payload of each block is written to sink, and a 2.31
+    # (Continue) response is sent until the last block, which gets a
+    # response with responseCode. Blocks out of order get a 4.08 response.
+    # Returns True when the last block has been received.
+    @synchronized
+    def receiveBlock(self, requestPacket, sourceIp, sourcePort, sink, responseCode=macros.COAP_RESPONSE_CODE.COAP_CHANGED):
+        block1 = requestPacket.getUintOption(macros.COAP_OPTION_NUMBER.COAP_BLOCK1)
+        if block1 is None:
+            if requestPacket.payload:
+                writeToSink(sink, requestPacket.payload)
+            self.sendResponse(sourceIp, sourcePort, requestPacket.messageid, None, responseCode, macros.COAP_CONTENT_FORMAT.COAP_NONE, requestPacket.token)
+            return True
+
+        (num, more, szx) = decodeBlock(block1)
+        key = transferKey(requestPacket, sourceIp, sourcePort)
+        reception = self.blockReceptions.get(key)
+        offset = num << (szx + 4)
+        payload = requestPacket.payload
+        payloadLen = len(payload) if payload else 0
+        duplicate = (reception is not None) and (num > 0) and (reception[0] == offset + payloadLen)
+        if (num > 0) and not duplicate and ((reception is None) or (reception[0] != offset)):
+            self.endBlockTransfer(self.blockReceptions, key)
+            self.sendResponse(
+                sourceIp,
+                sourcePort,
+                requestPacket.messageid,
+                None,
+                macros.COAP_RESPONSE_CODE.COAP_REQUEST_ENTITY_INCOMPLETE,
+                macros.COAP_CONTENT_FORMAT.COAP_NONE,
+                requestPacket.token,
+            )
+            return False
+
+        if payload and not duplicate:
+            writeToSink(sink, payload)
+
+        response = CoapPacket()
+        response.type = macros.COAP_TYPE.COAP_ACK
+        response.messageid = requestPacket.messageid
+        response.token = requestPacket.token
+        response.addUintOption(macros.COAP_OPTION_NUMBER.COAP_BLOCK1, encodeBlock(num, more, szx))
+        if more:
+            if reception is None:
+                reception = self.beginBlockTransfer(self.blockReceptions, key, 0)
+            reception[0] = offset + payloadLen
+            response.method = macros.COAP_RESPONSE_CODE.COAP_CONTINUE
+        else:
+            self.endBlockTransfer(self.blockReceptions, key)
+            response.method = responseCode
+        self.sendPacket(sourceIp, sourcePort, response)
+        return not more
+
+    # To be called by a request callback to respond with a representation that
+    # may need more than one block (Block2). source can be a bytes-like object,
+    # a file-like object or an iterable of bytes chunks. Only the requested
+    # block is read: bytes-like and seekable sources serve blocks in any order,
+    # other sources only sequentially, in which case the source passed along
+    # with requests for later blocks is ignored.
+    @synchronized
+    def sendBlockResponse(
+        self, sourceIp, sourcePort, requestPacket, source, responseCode=macros.COAP_RESPONSE_CODE.COAP_CONTENT, content_format=macros.COAP_CONTENT_FORMAT.COAP_NONE, blockSize=macros._BLOCK_SIZE
+    ):
+        szx = blockSizeToSzx(blockSize)
+        offset = 0
+        block2 = requestPacket.getUintOption(macros.COAP_OPTION_NUMBER.COAP_BLOCK2)
+        if block2 is not None:
+            (num, more, requestSzx) = decodeBlock(block2)
+            offset = num << (requestSzx + 4)
+            szx = min(szx, requestSzx)
+
+        key = transferKey(requestPacket, sourceIp, sourcePort)
+        production = self.blockProductions.get(key)
+        if (offset > 0) and (production is not None):
+            blockSource = production[0]
+        else:
+            blockSource = BlockSource(source)
+        block = blockSource.takeAt(offset, 16 << szx)
+        if block is None:
+            self.endBlockTransfer(self.blockProductions, key)
+            return self.sendResponse(
+                sourceIp,
+                sourcePort,
+                requestPacket.messageid,
+                None,
+                macros.COAP_RESPONSE_CODE.COAP_BAD_REQUEST,
+                macros.COAP_CONTENT_FORMAT.COAP_NONE,
+                requestPacket.token,
+            )
+        (data, more) = block
+        if more and blockSource.isSequential():
+            # the source cannot be read again, keep it for the next block
+            if (production is None) or (production[0] is not blockSource):
+                self.beginBlockTransfer(self.blockProductions, key, blockSource)
+        elif production is not None:
+            self.endBlockTransfer(self.blockProductions, key)
+
+        response = CoapPacket()
+        response.type = macros.COAP_TYPE.COAP_ACK
+        response.method = responseCode
+        response.messageid = requestPacket.messageid
+        response.token = requestPacket.token
+        response.content_format = content_format
+        response.payload = data
+        if more or (offset > 0):
+            response.addUintOption(macros.COAP_OPTION_NUMBER.COAP_BLOCK2, encodeBlock(offset >> (szx + 4), more, szx))
+        return self.sendPacket(sourceIp, sourcePort, response)
+
+    # The state of a served transfer is dropped if the transfer does not
+    # continue within the exchange lifetime.
+    @synchronized
+    def beginBlockTransfer(self, transfers, key, value):
+        self.endBlockTransfer(transfers, key)
+        state = [value, None]
+        state[1] = self.timers.schedule(macros._EXCHANGE_LIFETIME_MS, lambda k: transfers.pop(k, None), key)
+        transfers[key] = state
+        return state
+
+    @synchronized
+    def endBlockTransfer(self, transfers, key):
+        state = transfers.pop(key, None)
+        if state is not None:
+            self.timers.cancel(state[1])
+
+    # Starts counting packets, bytes and errors, and measuring the duration of
+    # the processing stages of packets. Returns the CoapMetrics.
+    def enableMetrics(self):
+        if self.metrics is None:
+            self.metrics = CoapMetrics()
+        return self.metrics
+
+    def disableMetrics(self):
+        self.metrics = None
+
+    # Exposes the metrics as a JSON resource that can be read with GET.
+    def addMetricsResource(self, url="metrics"):
+        self.enableMetrics()
+        self.addIncomingRequestCallback(
+            url,
+            lambda packet, ip, port: self.sendResponse(
+                ip,
+                port,
+                packet.messageid,
+                self.metrics.toJson() if self.metrics is not None else "{}",
+                macros.COAP_RESPONSE_CODE.COAP_CONTENT,
+                macros.COAP_CONTENT_FORMAT.COAP_APPLICATION_JSON,
+                packet.token,
+            ),
+            macros.COAP_METHOD.COAP_GET,
+        )
+
+    # Starts recording the last 'size' packets received and sent. Returns the
+    # CoapTracer, whose dump function formats them.
+    def enableTracing(self, size=macros._TRACE_SIZE):
+        if self.tracer is None:
+            self.tracer = CoapTracer(size)
+        return self.tracer
+
+    def disableTracing(self):
+        self.tracer = None
+
+    # Server side response cache
+    #
+    # Responses to GET requests for the route are cached for maxAge seconds:
+    # further requests are answered from the cache without calling the request
+    # callback. The response gets a Max-Age option and, unless the callback
+    # sets one, an ETag, so that requests with a matching ETag are answered
+    # with 2.03 (Valid). Only responses sent before the callback returns are
+    # cached.
+    def cacheResource(self, url, maxAge=macros._DEFAULT_MAX_AGE):
+        if self.responseCache is None:
+            self.responseCache = CoapResponseCache(macros._RESPONSE_CACHE_SIZE)
+        self.responseCache.routes["/".join([s for s in url.split("/") if s != ""])] = maxAge
+
+    # Drops the cached responses of a resource path, or all of them, e.g.
+    # when the resource changes.
+    def invalidateCache(self, path=None):
+        if self.responseCache is not None:
+            self.responseCache.invalidate(path)
+
+    # Answers a GET request from the cache. Returns False if the response has
+    # to be produced by the request callback.
+    def sendCachedResponse(self, handlers, requestPacket, sourceIp, sourcePort):
+        cache = self.responseCache
+        maxAge = cache.routes.get(handlers.url)
+        if (maxAge is None) or (requestPacket.method != macros.COAP_METHOD.COAP_GET):
+            return False
+        # observations and block-wise transfers are not cached
+        if (requestPacket.findOption(macros.COAP_OPTION_NUMBER.COAP_OBSERVE) >= 0) or (requestPacket.findOption(macros.COAP_OPTION_NUMBER.COAP_BLOCK2) >= 0):
+            return False
+
+        sockaddr = (sourceIp, sourcePort)
+        key = cache.requestKey(requestPacket)
+        entry = cache.lookup(key, self.timers.now())
+        if entry is None:
+            # store the response the callback is about to send
+            if len(cache.pending) >= cache.entries.size:
+                # offloaded callbacks that never responded
+                cache.pending.clear()
+            cache.pending[(sockaddr, requestPacket.messageid)] = (key, maxAge)
+            return False
+
+        # a piggybacked response echoes the message id of the request, a NON
+        # response has its own
+        if requestPacket.type == macros.COAP_TYPE.COAP_CON:
+            (type, messageid) = (macros.COAP_TYPE.COAP_ACK, requestPacket.messageid)
+        else:
+            (type, messageid) = (macros.COAP_TYPE.COAP_NONCON, self.nextMessageId())
+        token = bytes(requestPacket.token or b"")
+        if entry[1] in [bytes(etag) for etag in requestPacket.getOptions(macros.COAP_OPTION_NUMBER.COAP_E_TAG)]:
+            response = CoapPacket()
+            response.type = type
+            response.method = macros.COAP_RESPONSE_CODE.COAP_VALID
+            response.messageid = messageid
+            response.token = token
+            response.payload = None
+            response.addOption(macros.COAP_OPTION_NUMBER.COAP_E_TAG, entry[1])
+            response.addUintOption(macros.COAP_OPTION_NUMBER.COAP_MAX_AGE, maxAge)
+            self.sendPacketToAddress(sockaddr, response)
+            return True
+
+        data = entry[3]
+        start = macros._MESSAGE_HEAD_SIZE
+        end = start + len(data)
+        if end > len(self.txBuffer):
+            return False
+        with self.lock:
+            self.txBuffer[start:end] = data
+            start = writeMessageHead(self.txBuffer, start, type, entry[2], messageid, token)
+            if (self.sendBuffer(sockaddr, end, messageid, start) != 0) and self.discardRetransmissions and (type == macros.COAP_TYPE.COAP_ACK):
+                self.deduplicationCache.recordResponse((sockaddr, requestPacket.messageid), bytes(self.txView[start:end]))
+        return True
+
+    # Stores a response produced by a request callback, if it is awaited by
+    # the response cache.
+    def storeResponse(self, sockaddr, coapPacket):
+        cache = self.responseCache
+        pending = cache.pending.pop((sockaddr, coapPacket.messageid), None)
+        if (pending is None) or (coapPacket.method != macros.COAP_RESPONSE_CODE.COAP_CONTENT):
+            return
+        (key, maxAge) = pending
+
+        # add the cache options, then encode the options and the payload
+        # without the header, like they will be sent from the cache
+        coapPacket.prepareOptions()
+        coapPacket.content_format = macros.COAP_CONTENT_FORMAT.COAP_NONE
+        coapPacket.query = None
+        etag = coapPacket.getOpaqueOption(macros.COAP_OPTION_NUMBER.COAP_E_TAG)
+        if etag is None:
+            etag = cache.newEtag()
+            coapPacket.addOption(macros.COAP_OPTION_NUMBER.COAP_E_TAG, etag)
+        if coapPacket.findOption(macros.COAP_OPTION_NUMBER.COAP_MAX_AGE) < 0:
+            coapPacket.addUintOption(macros.COAP_OPTION_NUMBER.COAP_MAX_AGE, maxAge)
+        start = macros._MESSAGE_HEAD_SIZE
+        end = self.encodeCommonPart(coapPacket, start)
+        if end != 0:
+            cache.store(key, self.timers.now(), maxAge, etag, coapPacket.method, bytes(self.txView[start:end]))
+
+    # Observe (rfc7641)
+    #
+    # Registers a resource that clients can observe. producer is a function
+    # that returns the current representation of the resource. GET requests
+    # are answered with it, and clients that register with the Observe option
+    # receive a notification every time notify is called for the url.
+    def addObservableResource(self, url, producer, content_format=macros.COAP_CONTENT_FORMAT.COAP_NONE):
+        resource = CoapObservableResource(url, producer, content_format)
+        self.observableResources[url] = resource
+        self.addIncomingRequestCallback(
+            url, lambda packet, ip, port: self.handleObserveRequest(resource, packet, ip, port), macros.COAP_METHOD.COAP_GET
         )
+        return resource
+
+    @synchronized
+    def handleObserveRequest(self, resource, requestPacket, sourceIp, sourcePort):
+        peer = (sourceIp, sourcePort)
+        key = (peer, bytes(requestPacket.token or b""))
+        observe = requestPacket.getUintOption(macros.COAP_OPTION_NUMBER.COAP_OBSERVE)
+        if observe is not None:
+            if observe == 0:
+                resource.observers[key] = CoapObserver(peer, key[1])
+            else:
+                resource.observers.pop(key, None)
+
+        response = CoapPacket()
+        response.type = macros.COAP_TYPE.COAP_ACK
+        response.method = macros.COAP_RESPONSE_CODE.COAP_CONTENT
+        response.messageid = requestPacket.messageid
+        response.token = requestPacket.token
+        response.content_format = resource.content_format
+        response.payload = resource.producer()
+        if key in resource.observers:
+            response.addUintOption(macros.COAP_OPTION_NUMBER.COAP_OBSERVE, resource.sequence)
+        return self.sendPacket(sourceIp, sourcePort, response)
+
+    # Sends the current representation of an observable resource to all its
+    # observers. The notification is encoded once; only the header, the token
+    # and the Observe sequence number are written for each observer.
+    # Observers that reject a notification with RST, or do not acknowledge a
+    # confirmable one, are removed. Returns the number of notifications sent.
+    @synchronized
+    def notify(self, url, confirmable=False):
+        resource = self.observableResources.get(url)
+        if (resource is None) or not resource.observers:
+            return 0
+
+        resource.sequence = (resource.sequence + 1) & 0xFFFFFF
+
+        # options following Observe and the payload, common to all observers
+        packet = CoapPacket()
+        packet.content_format = resource.content_format
+        packet.payload = resource.producer()
+        packet.prepareOptions()
+        tailStart = macros._NOTIFICATION_HEAD_SIZE
+        end = self.encodeCommonPart(packet, tailStart, macros.COAP_OPTION_NUMBER.COAP_OBSERVE)
+        if end == 0:
+            return 0
+
+        type = macros.COAP_TYPE.COAP_CON if confirmable else macros.COAP_TYPE.COAP_NONCON
+        sent = 0
+        for observer in list(resource.observers.values()):
+            messageid = self.nextMessageId()
+            start = writeNotificationHead(self.txBuffer, tailStart, type, macros.COAP_RESPONSE_CODE.COAP_CONTENT, messageid, observer.token, resource.sequence)
+            if self.sendBuffer(observer.peer, end, messageid, start) == 0:
+                continue
+            sent += 1
+            observer.messageid = messageid
+            if confirmable:
+                callback = lambda packet, remoteAddress, observer=observer: resource.onNotificationResult(observer, packet)
+                transaction = self.beginTransaction(observer.peer, messageid, observer.token, type, callback, False)
+                self.armTransaction(transaction, end, start)
+        return sent
+
+    # Encodes the options and the payload of a message sent to many endpoints
+    # once, at 'start' in the transmission buffer, leaving room for the header
+    # and the token in front of it. Returns the end index, or 0 if it does not fit.
+    def encodeCommonPart(self, packet, start, previousNumber=0):
+        end = writePacketOptions(self.txBuffer, packet, start, previousNumber)
+        if end != 0:
+            end = writePayload(self.txBuffer, end, packet.payload)
+        if end == 0:
+            self.log("Packet does not fit in the transmission buffer")
+        return end
 
     def handleIncomingRequest(self, requestPacket, sourceIp, sourcePort):
-        url = ""
-        for opt in requestPacket.options:
-            if (opt.number == macros.COAP_OPTION_NUMBER.COAP_URI_PATH) and (len(opt.buffer) > 0):
-                if url != "":
-                    url += "/"
-                url += opt.buffer.decode("unicode_escape")
+        if (requestPacket.findOption(macros.COAP_OPTION_NUMBER.COAP_PROXY_URI) >= 0) or (requestPacket.findOption(macros.COAP_OPTION_NUMBER.COAP_PROXY_SCHEME) >= 0):
+            if self.proxy is not None:
+                self.proxy.handleRequest(requestPacket, sourceIp, sourcePort)
+            else:
+                self.sendResponse(
+                    sourceIp,
+                    sourcePort,
+                    requestPacket.messageid,
+                    None,
+                    macros.COAP_RESPONSE_CODE.COAP_PROXYING_NOT_SUPPORTED,
+                    macros.COAP_CONTENT_FORMAT.COAP_NONE,
+                    requestPacket.token,
+                )
+            return True
+
+        handlers = self.router.match(requestPacket)
 
         urlCallback = None
-        if url != "":
-            urlCallback = self.callbacks.get(url)
+        if handlers is not None:
+            urlCallback = handlers.get(requestPacket.method)
+            if urlCallback is None:
+                urlCallback = handlers.get(None)
 
         if urlCallback is None:
-            if self.responseCallback:
-                # The incoming request may be a response, let the responseCallback handle it.
-                return False
-            print("Callback for url [", url, "] not found")
+            responseCode = macros.COAP_RESPONSE_CODE.COAP_NOT_FOUND
+            if handlers is not None:
+                responseCode = macros.COAP_RESPONSE_CODE.COAP_METHOD_NOT_ALLOWD
+            elif self.metrics is not None:
+                self.metrics.notFound += 1
+            self.log("No callback for request with messageid: " + str(requestPacket.messageid))
             self.sendResponse(
                 sourceIp,
                 sourcePort,
                 requestPacket.messageid,
                 None,
-                macros.COAP_RESPONSE_CODE.COAP_NOT_FOUND,
+                responseCode,
                 macros.COAP_CONTENT_FORMAT.COAP_NONE,
                 requestPacket.token,
             )
 
         else:
-            urlCallback(requestPacket, sourceIp, sourcePort)
+            if self.metrics is not None:
+                self.metrics.countRequest(handlers.url)
+            if self.responseCache is not None:
+                if self.sendCachedResponse(handlers, requestPacket, sourceIp, sourcePort):
+                    return True
+                self.runRequestCallback(urlCallback, requestPacket, sourceIp, sourcePort)
+                if self.handlerPool is None:
+                    # the callback did not respond
+                    self.responseCache.pending.pop(((sourceIp, sourcePort), requestPacket.messageid), None)
+            else:
+                self.runRequestCallback(urlCallback, requestPacket, sourceIp, sourcePort)
         return True
 
+    def runRequestCallback(self, callback, requestPacket, sourceIp, sourcePort):
+        if self.handlerPool is not None:
+            self.handlerPool.submit(callback, requestPacket, sourceIp, sourcePort)
+        else:
+            callback(requestPacket, sourceIp, sourcePort)
+
     def readBytesFromSocket(self, numOfBytes):
         try:
             return self.sock.recvfrom(numOfBytes)
         except Exception:
             return (None, None)
 
+    # Returns (buffer, length, remoteAddress) of the next datagram, or
+    # (None, 0, None) if none could be read. The datagram is received into the
+    # next buffer of the pool when possible, without any allocation.
+    def receiveDatagram(self):
+        if not hasattr(self.sock, "recvfrom_into"):
+            (buffer, remoteAddress) = self.readBytesFromSocket(macros._BUF_MAX_SIZE)
+            return (buffer, 0 if buffer is None else len(buffer), remoteAddress)
+
+        if self.rxBuffers is None:
+            self.rxBuffers = [bytearray(macros._BUF_MAX_SIZE) for _ in range(macros._RX_BUFFER_POOL_SIZE)]
+        buffer = self.rxBuffers[self.rxIndex]
+        try:
+            (length, remoteAddress) = self.sock.recvfrom_into(buffer)
+        except Exception:
+            return (None, 0, None)
+        self.rxIndex = (self.rxIndex + 1) % len(self.rxBuffers)
+        return (buffer, length, remoteAddress)
+
     def parsePacketToken(self, buffer, packet):
         if packet.tokenLength == 0:
             packet.token = None
-        elif packet.tokenLength <= 8:
+        elif packet.tokenLength <= 8 and (4 + packet.tokenLength) <= len(buffer):
             packet.token = buffer[4 : 4 + packet.tokenLength]
         else:
-            (tempBuffer, tempRemoteAddress) = self.readBytesFromSocket(macros._BUF_MAX_SIZE - bufferLen)
-            if tempBuffer is not None:
-                buffer.extend(tempBuffer)
+            # token lengths 9-15 are reserved (rfc7252 #3)
             return False
         return True
 
     def loop(self, blocking=True):
         if self.sock is None:
+            if blocking and (self.workerPool is not None):
+                # the workers receive the packets, block instead of returning at once
+                self.workerPool.wait(macros._ACK_TIMEOUT_MS / 1000)
             return False
 
+        if self.timers.heap:
+            with self.lock:
+                self.timers.run()
+
+        if blocking and (not self.isCustomSocket) and (self.timers.heap or (self.handlerPool is not None)):
+            # wait for the next timer at most, or until a handler thread
+            # schedules an earlier one
+            with self.lock:
+                delayMs = self.timers.nextDelayMs()
+            readable = self.waitReadable(delayMs)
+            if readable is False:
+                with self.lock:
+                    self.timers.run()
+                return False
+            if readable:
+                blocking = False
+
+        # a blocking read also waits for the datagram, so only non-blocking
+        # reads are timed
+        metrics = None if blocking else self.metrics
+        if metrics is not None:
+            startUs = ticksUs()
         self.sock.setblocking(blocking)
-        (buffer, remoteAddress) = self.readBytesFromSocket(macros._BUF_MAX_SIZE)
+        (buffer, length, remoteAddress) = self.receiveDatagram()
         self.sock.setblocking(True)
 
-        while (buffer is not None) and (len(buffer) > 0):
-            bufferLen = len(buffer)
-            if (bufferLen < macros._COAP_HEADER_SIZE) or (((buffer[0] & 0xC0) >> 6) != 1):
-                (tempBuffer, tempRemoteAddress) = self.readBytesFromSocket(macros._BUF_MAX_SIZE - bufferLen)
-                if tempBuffer is not None:
-                    buffer.extend(tempBuffer)
-                continue
+        if (buffer is None) or (length == 0):
+            return False
+        if metrics is not None:
+            metrics.record(STAGE_RECEIVE, ticksDiff(ticksUs(), startUs))
+        with self.lock:
+            return self.processDatagram(buffer, remoteAddress, length)
 
-            packet = CoapPacket()
+    # Waits until a datagram can be read, for at most timeoutMs (forever if
+    # negative). Returns False on timeout, or when woken up for the timers,
+    # and None if the socket cannot be waited for.
+    def waitReadable(self, timeoutMs):
+        sockets = [self.sock]
+        pool = self.handlerPool
+        if pool is not None:
+            sockets.append(pool.wakeupReader)
+        try:
+            readable = select.select(sockets, [], [], None if timeoutMs < 0 else timeoutMs / 1000)[0]
+        except (TypeError, ValueError):
+            return None
+        if (pool is not None) and (pool.wakeupReader in readable):
+            pool.clearWakeup()
+        return self.sock in readable
 
-            self.log("Incoming Packet bytes: " + str(binascii.hexlify(bytearray(buffer))))
+    # Parses a received datagram, the first 'length' bytes of buffer, and
+    # dispatches it either to the registered request callbacks or to the
+    # response handling.
+    def processDatagram(self, buffer, remoteAddress, length=None):
+        if length is None:
+            length = len(buffer)
+        metrics = self.metrics
+        if metrics is not None:
+            startUs = ticksUs()
+            metrics.packetsIn += 1
+            metrics.bytesIn += length
 
-            parsePacketHeaderInfo(buffer, packet)
+        packet = self.parseDatagram(buffer, length)
+        if self.tracer is not None:
+            if packet is None:
+                self.tracer.record(ticksMs(), TRACE_IN, remoteAddress, 0, None, None, length)
+            else:
+                self.tracer.record(ticksMs(), TRACE_IN, remoteAddress, packet.messageid, packet.type, packet.method, length)
+        if packet is None:
+            if metrics is not None:
+                metrics.parseFailures += 1
+            return False
+        if metrics is not None:
+            dispatchUs = ticksUs()
+            metrics.record(STAGE_PARSE, ticksDiff(dispatchUs, startUs))
 
-            if not self.parsePacketToken(buffer, packet):
-                continue
+        if self.discardRetransmissions and (packet.type <= macros.COAP_TYPE.COAP_NONCON) and self.isDuplicate(packet, remoteAddress):
+            return False
 
-            if not parsePacketOptionsAndPayload(buffer, packet):
-                return False
+        status = self.dispatchPacket(packet, remoteAddress)
 
-            # beta functionality
-            if self.discardRetransmissions:
-                if packet.toString() == self.lastPacketStr:
-                    self.log("Discarded retransmission message: " + packet.toString())
-                    return False
-                else:
-                    self.lastPacketStr = packet.toString()
-            ####
-
-            if not self.isServer or not self.handleIncomingRequest(packet, remoteAddress[0], remoteAddress[1]):
-                # To handle cases of Separate response (rfc7252 #5.2.2)
-                if packet.type == macros.COAP_TYPE.COAP_ACK and packet.method == macros.COAP_METHOD.COAP_EMPTY_MESSAGE:
-                    self.state = self.TRANSMISSION_STATE.STATE_SEPARATE_ACK_RECEIVED_WAITING_DATA
-                    return False
-                # case of piggybacked response where the response is in the ACK (rfc7252 #5.2.1)
-                # or the data of a separate message
-                else:
-                    if self.state == self.TRANSMISSION_STATE.STATE_SEPARATE_ACK_RECEIVED_WAITING_DATA:
-                        self.state = self.TRANSMISSION_STATE.STATE_IDLE
-                        self.sendResponse(
-                            remoteAddress[0],
-                            remoteAddress[1],
-                            packet.messageid,
-                            None,
-                            macros.COAP_TYPE.COAP_ACK,
-                            macros.COAP_CONTENT_FORMAT.COAP_NONE,
-                            packet.token,
-                        )
-                    if self.responseCallback is not None:
-                        self.responseCallback(packet, remoteAddress)
-            return True
+        if metrics is not None:
+            metrics.record(STAGE_DISPATCH, ticksDiff(ticksUs(), dispatchUs))
+        return status
 
-        return False
+    # Passes a received packet to the request callbacks or to the response handling.
+    def dispatchPacket(self, packet, remoteAddress):
+        isRequest = (packet.method != macros.COAP_METHOD.COAP_EMPTY_MESSAGE) and ((packet.method & 0xE0) == 0)
+        if not (self.isServer and isRequest) or not self.handleIncomingRequest(packet, remoteAddress[0], remoteAddress[1]):
+            return self.handleResponse(packet, remoteAddress)
+        return True
+
+    # Returns the packet decoded from the first 'length' bytes of buffer, or
+    # None if they are not a valid message.
+    def parseDatagram(self, buffer, length):
+        # a datagram holds exactly one message, shorter ones and unknown
+        # versions are silently ignored (rfc7252 #3)
+        if (length < macros._COAP_HEADER_SIZE) or (((buffer[0] & 0xC0) >> 6) != macros.COAP_VERSION.COAP_VERSION_1):
+            return None
+
+        packet = CoapPacket()
+
+        buffer = memoryview(buffer)[:length]
+        if self.debug:
+            self.log("Incoming Packet bytes: " + str(binascii.hexlify(buffer)))
+
+        parsePacketHeaderInfo(buffer, packet)
+
+        if not self.parsePacketToken(buffer, packet):
+            return None
+
+        if not parsePacketOptionsAndPayload(buffer, packet):
+            return None
+
+        if not self.zeroCopyDecode:
+            # the receive buffer is reused, copy the values out of it
+            packet.materialize()
+        return packet
+
+    def isDuplicate(self, packet, remoteAddress):
+        lifetime = macros._EXCHANGE_LIFETIME_MS if packet.type == macros.COAP_TYPE.COAP_CON else macros._NON_LIFETIME_MS
+        entry = self.deduplicationCache.check((remoteAddress, packet.messageid), self.timers.now(), lifetime)
+        if entry is None:
+            return False
+
+        self.log("Discarded retransmission of messageid: " + str(packet.messageid))
+        if self.metrics is not None:
+            self.metrics.duplicates += 1
+        if entry[1] is not None:
+            try:
+                self.sock.sendto(entry[1], remoteAddress)
+            except Exception as e:
+                self.log("Exception while resending response: " + str(e))
+        return True
+
+    def handleResponse(self, packet, remoteAddress):
+        transaction = None
+        if packet.type == macros.COAP_TYPE.COAP_ACK or packet.type == macros.COAP_TYPE.COAP_RESET:
+            transaction = self.transactionsByMessageId.get((remoteAddress, packet.messageid))
+            if (transaction is not None) and (transaction.sentMs is not None) and (self.congestionControl is not None):
+                # the first ACK/RST of a confirmable message gives an RTT sample
+                nowMs = self.timers.now()
+                self.congestionControl.onRttSample(remoteAddress, nowMs - transaction.sentMs, transaction.retransmissions, nowMs)
+                transaction.sentMs = None
+                self.congestionControl.onReceive(remoteAddress)
+
+        if (transaction is not None) and not transaction.isRequest:
+            # ACK or RST of a notification
+            self.endTransaction(transaction)
+            if transaction.callback is not None:
+                transaction.callback(packet, remoteAddress)
+            return False
+
+        if (transaction is None) and (packet.type == macros.COAP_TYPE.COAP_RESET) and self.observableResources:
+            # a client rejected a non confirmable notification
+            for resource in self.observableResources.values():
+                resource.removeObserverByMessageId(remoteAddress, packet.messageid)
+
+        # To handle cases of Separate response (rfc7252 #5.2.2)
+        if packet.type == macros.COAP_TYPE.COAP_ACK and packet.method == macros.COAP_METHOD.COAP_EMPTY_MESSAGE:
+            self.state = self.TRANSMISSION_STATE.STATE_SEPARATE_ACK_RECEIVED_WAITING_DATA
+            if (transaction is not None) and not transaction.separate:
+                # stop retransmitting and wait for the response until the exchange lifetime
+                transaction.separate = True
+                self.timers.cancel(transaction.timer)
+                transaction.data = None
+                transaction.timer = self.timers.schedule(macros._EXCHANGE_LIFETIME_MS, self.expireTransaction, transaction)
+            return False
+
+        # case of piggybacked response where the response is in the ACK (rfc7252 #5.2.1)
+        # or the data of a separate message
+        if transaction is None:
+            transaction = self.transactions.get((remoteAddress, bytes(packet.token or b"")))
+
+        if packet.type == macros.COAP_TYPE.COAP_CON:
+            self.sendEmptyAck(remoteAddress, packet.messageid)
+        self.state = self.TRANSMISSION_STATE.STATE_IDLE
+
+        callback = self.responseCallback
+        if transaction is not None:
+            if self.congestionControl is not None:
+                self.congestionControl.onReceive(remoteAddress)
+            self.endTransaction(transaction)
+            if (transaction.cacheKey is not None) and (self.clientCache is not None):
+                packet = self.clientCache.onResponse(transaction.cacheKey, packet, self.timers.now())
+            if transaction.callback is not None:
+                callback = transaction.callback
+        if callback is not None:
+            callback(packet, remoteAddress)
+        return True
 
     def poll(self, timeoutMs=-1, pollPeriodMs=500):
-        start_time = time.ticks_ms()
+        start_time = ticksMs()
         status = False
         while not status:
             status = self.loop(False)
-            if time.ticks_diff(time.ticks_ms(), start_time) >= timeoutMs:
+            if ticksDiff(ticksMs(), start_time) >= timeoutMs:
                 break
-            time.sleep_ms(pollPeriodMs)
+            # wake up earlier if a retransmission is due
+            sleepPeriodMs = pollPeriodMs
+            with self.lock:
+                timerDelayMs = self.timers.nextDelayMs()
+            if 0 <= timerDelayMs < sleepPeriodMs:
+                sleepPeriodMs = timerDelayMs
+            sleepMs(sleepPeriodMs)
         return status